@@ -1,56 +1,213 @@
+import functools
+import html
 import os
 import re
+import time
 import streamlit as st
 import datetime
-import stripe
-import firebase_admin
 from dotenv import load_dotenv
-from anthropic import Anthropic
 from streamlit_option_menu import option_menu
-from firebase_config import auth
-from firestore_config import db
-from firebase_admin import credentials, firestore
+from firebase_config import USE_LOCAL_BACKEND, get_auth, get_db
+from conversation_store import ConversationStore
+from mastery import DEFAULT_DIFFICULTY, MasteryStore, empty_mastery, quiz_difficulty
+from spaced_repetition import GRADE_AGAIN, GRADE_GOOD, ReviewCard, ReviewScheduler
+from usage_meter import UsageMeter
+from token_meter import SYSTEM_ACCOUNT, TokenMeter
+from model_routing import classify_question, escalate, pick_route, run_with_escalation
+from model_service import ModelService, cache_conversation_prefix
+from conversation_context import ConversationContext
+from question_pool import QuestionPool
+from response_cache import ResponseCache
+from telemetry import TELEMETRY, TracedModelClient, set_tags, span, tags
+from study_items import (
+    FLASHCARD_TOOL, QUIZ_TOOL, parse_flashcards, parse_quiz_questions, request_structured
+)
+
+# Configure page settings (must be the first Streamlit command; cache_resource spinners count)
+st.set_page_config(
+    page_title="AI Tutor Agent", 
+    layout="centered",
+    initial_sidebar_state="expanded"
+)
 
-# only initialize the default app if it hasn’t been already
-if not firebase_admin._apps:
-    cred = credentials.Certificate("firebase-service-account.json")
-    firebase_admin.initialize_app(cred)
+# Spans opened during this run are tagged with its mode/topic once they're known
+set_tags()
 
-db = firestore.client()
+# Shared, lazily initialized Firestore client
+db = get_db()
 
 
-# Stripe integration
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# Atomic per-day usage counters
+@st.cache_resource
+def get_usage_meter():
+    return UsageMeter(db)
+
+usage_meter = get_usage_meter()
+
+
+# Token usage per user, day and mode, taken from each response and flushed in the background
+@st.cache_resource
+def get_token_meter():
+    return TokenMeter(db, flush_interval=5.0)
+
+token_meter = get_token_meter()
+
+# get today's date as a string
+def get_today_str():
+    return datetime.datetime.now().strftime("%Y-%m-%d")
+
+def record_token_usage(email, span, message):
+    """Charge a finished response's tokens to the user's day, under the mode it was made in"""
+    day = get_today_str()
+    if email == SYSTEM_ACCOUNT:
+        # Users' days are loaded at login; the shared account's is loaded on its first call of the day
+        try:
+            token_meter.load(email, day)
+        except Exception:
+            # Still recorded and flushed; only the in-memory total misses what's already stored
+            pass
+    token_meter.record(email, day, span.attributes.get("mode", "other"), span.attributes.get("model"), message.usage)
+
+
+# Q&A conversations persisted as append-only message batches, read back a page at a time
+QA_HISTORY_PAGE_SIZE = 20
+
+@st.cache_resource
+def get_conversation_store():
+    return ConversationStore(db, page_size=QA_HISTORY_PAGE_SIZE)
+
+conversation_store = get_conversation_store()
+
+# Reviewed flashcards with their SM-2 schedule; each user's due queue is a heap in memory
+@st.cache_resource
+def get_review_scheduler():
+    return ReviewScheduler(db)
+
+review_scheduler = get_review_scheduler()
+
+# Quiz/flashcard event log plus per-topic aggregates kept precomputed in one document
+@st.cache_resource
+def get_mastery_store():
+    return MasteryStore(db)
+
+mastery_store = get_mastery_store()
+
+def record_mastery(kind, topic, correct, latency_seconds=None):
+    """Queue the answer's mastery write; a failed save is reported on a later rerun"""
+    future = mastery_store.record(
+        current_user, st.session_state.mastery, kind, topic, correct, latency_seconds=latency_seconds
+    )
+    st.session_state.setdefault("mastery_writes", []).append(future)
+
+def report_failed_mastery_writes():
+    writes = st.session_state.get("mastery_writes", [])
+    failed = [future for future in writes if future.done() and future.exception() is not None]
+    st.session_state.mastery_writes = [future for future in writes if not future.done()]
+    if failed:
+        st.warning(f"⚠️ {len(failed)} answer(s) couldn't be saved to your progress. Your stats may be behind until you log in again.")
+
+
+# Stripe integration (imported and configured only when a checkout is needed)
+@st.cache_resource
+def get_stripe():
+    if USE_LOCAL_BACKEND:
+        from local_backend import LocalStripe
+        return LocalStripe()
+
+    import stripe
+
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+    return stripe
+
+# Checkout sessions expire after this long; Stripe's minimum is 30 minutes
+CHECKOUT_SESSION_TTL_SECONDS = 30 * 60
 
 def create_checkout_session(user_email):
     try:
-        checkout_session = stripe.checkout.Session.create(
-            success_url="https://your-site.streamlit.app?session=success",
-            cancel_url="https://your-site.streamlit.app?session=cancel",
-            payment_method_types=["card"],
-            mode="payment",  # or "subscription" for monthly
-            line_items=[{
-                "price_data": {
-                    "currency": "usd",
-                    "product_data": {
-                        "name": "Tutor Pro Plan",
+        stripe = get_stripe()
+        with span("stripe", "checkout.create"):
+            checkout_session = stripe.checkout.Session.create(
+                expires_at=int(time.time()) + CHECKOUT_SESSION_TTL_SECONDS,
+                success_url="https://your-site.streamlit.app?session=success",
+                cancel_url="https://your-site.streamlit.app?session=cancel",
+                payment_method_types=["card"],
+                mode="payment",  # or "subscription" for monthly
+                line_items=[{
+                    "price_data": {
+                        "currency": "usd",
+                        "product_data": {
+                            "name": "Tutor Pro Plan",
+                        },
+                        "unit_amount": 1500,  # $15 in cents
                     },
-                    "unit_amount": 1500,  # $15 in cents
-                },
-                "quantity": 1,
-            }],
-            metadata={"email": user_email}
-        )
-        return checkout_session.url
+                    "quantity": 1,
+                }],
+                metadata={"email": user_email}
+            )
+        return checkout_session
     except Exception as e:
         st.error(f"⚠️ Failed to create checkout: {str(e)}")
         return None
 
+# Open checkout URLs per user, shared across sessions and reruns
+@st.cache_resource
+def get_checkout_cache():
+    return {}
+
+def get_checkout_url(user_email, create=True):
+    """Reuse the user's unexpired checkout session, creating one only if `create` is set"""
+    checkout_cache = get_checkout_cache()
+    cached = checkout_cache.get(user_email)
+    # Leave a minute of slack so we never hand out a link that is about to expire
+    if cached and cached["expires_at"] - 60 > time.time():
+        return cached["url"]
+    if not create:
+        return None
+
+    checkout_session = create_checkout_session(user_email)
+    if checkout_session is None:
+        return None
+
+    checkout_cache[user_email] = {
+        "url": checkout_session.url,
+        "expires_at": checkout_session.expires_at,
+    }
+    return checkout_session.url
+
+
+# Cached user profile (one Firestore read per TTL instead of several per rerun)
+USER_DOC_TTL_SECONDS = 60
+
+def load_user_doc(email, force_refresh=False):
+    """Return the users/{email} document as a dict, served from session state while fresh"""
+    if "user_doc_reads_saved" not in st.session_state:
+        st.session_state.user_doc_reads_saved = 0
+
+    cache = st.session_state.get("user_doc_cache")
+    now = time.time()
+    if (
+        not force_refresh
+        and cache is not None
+        and cache["email"] == email
+        and now - cache["fetched_at"] < USER_DOC_TTL_SECONDS
+    ):
+        st.session_state.user_doc_reads_saved += 1
+        return cache["data"]
 
-# Save progress to Firestore
-def save_user_progress(email, data_type, data):
-    user_doc = db.collection("users").document(email)
-    user_doc.set({data_type: data}, merge=True)
+    with span("firestore", "profile.load"):
+        user_doc = db.collection("users").document(email).get()
+    data = user_doc.to_dict() if user_doc.exists else {}
+    st.session_state.user_doc_cache = {"email": email, "data": data, "fetched_at": now}
+    return data
+
+def update_user_doc_cache(email, fields):
+    """Apply our own merge-writes to the cached profile so it never goes stale"""
+    cache = st.session_state.get("user_doc_cache")
+    if cache is not None and cache["email"] == email:
+        cache["data"].update(fields)
+
+def clear_user_doc_cache():
+    st.session_state.pop("user_doc_cache", None)
 
 
 # Email Validation
@@ -66,44 +223,155 @@ def is_valid_email(email):
 # Load environment variables and API key
 load_dotenv()
 api_key = os.getenv("ANTHROPIC_API_KEY")
-client = Anthropic(api_key=api_key)
+
+# Every model call in the process goes through one pooled, concurrency-limited async client,
+# and every client handed out is wrapped so its calls are recorded as telemetry spans
+@st.cache_resource
+def get_model_service():
+    if USE_LOCAL_BACKEND:
+        from local_backend import LocalModelService
+        return LocalModelService.from_env()
+    return ModelService(api_key=api_key, max_concurrency=16, per_user_concurrency=2)
+
+model_service = get_model_service()
+
+# Shared lane for background work (pool refills); sessions get their own lane after login.
+# Its tokens are charged to the shared system account rather than to any student.
+background_client = TracedModelClient(
+    model_service.for_user(None), on_response=functools.partial(record_token_usage, SYSTEM_ACCOUNT)
+)
 
 # Initialize session state for theme tracking
 if "theme_mode" not in st.session_state:
     st.session_state.theme_mode = "dark"  # Default to dark theme
 
-# Configure page settings
-st.set_page_config(
-    page_title="AI Tutor Agent", 
-    layout="centered",
-    initial_sidebar_state="expanded"
+# ============================================================================
+# QUIZ QUESTION POOL
+# ============================================================================
+
+CORE_QUIZ_TOPICS = ["General", "Math", "Science", "History", "Programming"]
+QUIZ_BATCH_SIZE = 8
+QUIZ_POOL_LOW_WATER = 3
+
+# Static instructions live in the system prompt; only the topic varies per call. (It and the tool
+# schema are ~400 tokens, well under the minimum prefix Anthropic will cache, so it isn't marked.)
+QUIZ_SYSTEM_PROMPT = (
+    "You write multiple choice quiz questions for students. Questions should be clear, "
+    "accurate and suitable for students, and a batch should cover a variety of subtopics. "
+    "Each question has four options A-D, exactly one correct answer letter, "
+    "and a brief explanation of why that answer is correct. "
+    "Always reply by calling the record_quiz_questions tool."
+)
+
+# Difficulty is picked per student and topic from their recent accuracy (see mastery.py)
+QUIZ_DIFFICULTY_GUIDANCE = {
+    "easy": "Keep them easy: recall of core definitions and basic facts, with clearly wrong distractors.",
+    "medium": "Make them medium difficulty: applying concepts to simple examples.",
+    "hard": "Make them hard: multi-step reasoning and edge cases, with common misconceptions as distractors.",
+}
+
+def generate_quiz_batch(pool_key):
+    """Ask for several quiz questions at one difficulty in one structured call"""
+    topic, difficulty = pool_key
+    quiz_prompt = (
+        f"Create {QUIZ_BATCH_SIZE} different multiple choice quiz questions on the topic of '{topic}'. "
+        f"{QUIZ_DIFFICULTY_GUIDANCE[difficulty]}"
+    )
+    # The pool is shared by every tier, so batches use the free-tier route
+    with tags(mode="quiz", topic=topic, difficulty=difficulty):
+        return run_with_escalation(pick_route("quiz", "free"), lambda route: request_structured(
+            background_client, QUIZ_TOOL, parse_quiz_questions, quiz_prompt,
+            model=route.model,
+            system=QUIZ_SYSTEM_PROMPT,
+            max_tokens=route.max_tokens,
+            temperature=0.8
+        ))
+
+# Shared by every session in this process and partitioned by (topic, difficulty);
+# popular topics start filling at the default level right away
+@st.cache_resource
+def get_quiz_pool():
+    pool = QuestionPool(generate_quiz_batch, low_water=QUIZ_POOL_LOW_WATER)
+    pool.prewarm((topic, DEFAULT_DIFFICULTY) for topic in CORE_QUIZ_TOPICS)
+    return pool
+
+quiz_pool = get_quiz_pool()
+
+# ============================================================================
+# Q&A ANSWER CACHE
+# ============================================================================
+
+# Shared by every session so common first questions per topic skip the model
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(similarity_threshold=0.9, ttl_seconds=24 * 3600, max_entries=2000)
+
+response_cache = get_response_cache()
+
+# ============================================================================
+# FLASHCARD DECKS
+# ============================================================================
+
+FLASHCARD_DECK_SIZE = 10
+
+FLASHCARD_SYSTEM_PROMPT = (
+    "You write educational flashcards for students. Each card covers a different key concept, "
+    "with a clear, concise question and a comprehensive answer with explanation. "
+    "Always reply by calling the record_flashcards tool."
 )
 
+def generate_flashcard_deck(topic, tier="free"):
+    """Ask for a whole deck of topic-specific flashcards in one structured call"""
+    flashcard_prompt = (
+        f"Create {FLASHCARD_DECK_SIZE} different educational flashcards for a student studying '{topic}'."
+    )
+    return run_with_escalation(pick_route("flashcard", tier), lambda route: request_structured(
+        client, FLASHCARD_TOOL, parse_flashcards, flashcard_prompt,
+        model=route.model,
+        system=FLASHCARD_SYSTEM_PROMPT,
+        max_tokens=route.max_tokens,
+        temperature=0.6
+    ))
+
 # ============================================================================
 # DYNAMIC THEME STYLING
 # ============================================================================
 
+STYLESHEET_PATH = "styles.css"
+
+def minify_css(css):
+    """Strip comments and redundant whitespace from a stylesheet"""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = css.replace(": ", ":").replace(";}", "}")
+    return css.strip()
+
+@st.cache_data(show_spinner=False)
+def render_theme_css(theme, css_mtime):
+    """Build the full <style> block for a theme once per process (mtime busts the cache in dev)"""
+    with open(STYLESHEET_PATH) as css_file:
+        css_content = css_file.read()
+
+    # Add theme-specific variables to the app container
+    themed_css = f"""
+    {css_content}
+
+    /* Force theme application */
+    .stApp {{
+        {get_theme_variables(theme)}
+    }}
+    """
+    return f"<style>{minify_css(themed_css)}</style>"
+
 def apply_theme_styling():
     """Apply dynamic CSS based on current theme selection"""
     theme = st.session_state.theme_mode
     
-    # Load and inject CSS with theme variables
+    # Streamlit drops any element a rerun doesn't emit, so the (cached) CSS is re-sent each run
     try:
-        with open("styles.css") as css_file:
-            css_content = css_file.read()
-            
-        # Add theme-specific class to the app container
-        theme_injection = f"""
-        <style>
-        {css_content}
-        
-        /* Force theme application */
-        .stApp {{
-            {get_theme_variables(theme)}
-        }}
-        </style>
-        """
-        st.markdown(theme_injection, unsafe_allow_html=True)
+        css_mtime = os.path.getmtime(STYLESHEET_PATH)
+        st.markdown(render_theme_css(theme, css_mtime), unsafe_allow_html=True)
         
     except FileNotFoundError:
         st.error("❌ styles.css file not found. Please ensure it's in the same directory as app.py")
@@ -191,7 +459,7 @@ with st.sidebar:
         with col1:
             if st.button("🔓 Log In"):
                 try:
-                    user = auth.sign_in_with_email_and_password(login_email, login_password)
+                    user = get_auth().sign_in_with_email_and_password(login_email, login_password)
                     st.session_state.user = user
                     st.success("✅ Logged in successfully!")
                     st.rerun()
@@ -201,15 +469,15 @@ with st.sidebar:
         with col2:
             if st.button("📝 Sign Up"):
                 if not is_valid_email(login_email):
-                 st.error("❌ Please enter a valid email address.")
-            else:
-                try:
-                    user = auth.create_user_with_email_and_password(login_email, login_password)
-                    st.session_state.user = user
-                    st.success("🎉 Account created. You can now log in.")
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"❌ Sign-up failed: {str(e)}")
+                    st.error("❌ Please enter a valid email address.")
+                else:
+                    try:
+                        user = get_auth().create_user_with_email_and_password(login_email, login_password)
+                        st.session_state.user = user
+                        st.success("🎉 Account created. You can now log in.")
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"❌ Sign-up failed: {str(e)}")
 
 
         st.stop()  # Prevent app from loading if not logged in
@@ -221,13 +489,14 @@ with st.sidebar:
         st.success(f"👋 Logged in as: {user_email}")
         current_user = user_email
 
+        # Route this session's model calls through its own fairness lane
+        client = TracedModelClient(
+            model_service.for_user(user_email), on_response=functools.partial(record_token_usage, user_email)
+        )
+
         # 🔐 Check if user is Pro
-        user_doc = db.collection("users").document(user_email).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            st.session_state.is_pro = user_data.get("pro", False)
-        else:
-            st.session_state.is_pro = False
+        user_data = load_user_doc(user_email)
+        st.session_state.is_pro = user_data.get("pro", False)
 
         # Show Pro status
         if st.session_state.is_pro:
@@ -236,17 +505,23 @@ with st.sidebar:
             st.info("🔓 Free tier (daily limits apply)")
 
 
-        # Load previous user progress
-        user_doc = db.collection("users").document(user_email).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            st.session_state.quiz_score = user_data.get("quiz_score", {"correct": 0, "total": 0})
-            st.session_state.flashcard_score = user_data.get("flashcard_score", {"got_it": 0, "missed": 0})
+        # Load per-topic progress once per login (older accounts are seeded from their global scores)
+        if "mastery" not in st.session_state:
+            st.session_state.mastery = mastery_store.load(user_email, user_data)
+        report_failed_mastery_writes()
 
+        st.caption(f"🗄️ Profile reads saved this session: {st.session_state.user_doc_reads_saved}")
 
         # 🔓 Logout Button
         if st.button("🚪 Log Out", use_container_width=True):
+            review_scheduler.forget(user_email)
             st.session_state.user = None
+            clear_user_doc_cache()
+            # Chat history lives in Firestore now; don't leave it behind for the next login
+            for key in ["messages", "qa_context", "qa_conversation_id", "qa_next_seq",
+                        "qa_has_earlier", "qa_history_loaded", "qa_history_window", "qa_asked_this_session",
+                        "usage_loaded", "mastery", "mastery_writes"]:
+                st.session_state.pop(key, None)
             st.success("✅ You have been logged out.")
             st.rerun()
 
@@ -254,13 +529,22 @@ with st.sidebar:
     # Progress reset button
     if st.button("🔄 Reset Progress", use_container_width=True):
         session_keys_to_reset = [
-            "messages", "quiz_score", "flashcard_score",
+            "messages", "qa_context", "qa_conversation_id", "qa_next_seq",
+            "qa_has_earlier", "qa_history_window", "qa_asked_this_session",
             "current_quiz", "current_flashcard", "show_answer"
         ]
         for key in session_keys_to_reset:
             if key in st.session_state:
                 del st.session_state[key]
-        st.success("✅ Progress reset successfully!")
+        try:
+            st.session_state.mastery = mastery_store.reset(current_user)
+            st.success("✅ Progress reset successfully!")
+        except TimeoutError:
+            # Still queued behind this user's earlier answers, and it will land after them
+            st.session_state.mastery = empty_mastery()
+            st.warning("⏳ Progress reset is taking a while to save. It will finish in the background.")
+        except Exception as e:
+            st.error(f"❌ Couldn't reset your progress: {str(e)}")
         st.rerun()
 
     st.markdown("---")
@@ -271,6 +555,7 @@ with st.sidebar:
         options=["Q&A Chat", "Quiz Mode", "Flashcards"],
         icons=["chat-dots", "question-circle", "journal-text"],
         default_index=0,
+        key="selected_mode",
         styles={
             "container": {"padding": "0!important", "border-radius": "5px"},
             "icon": {"color": "var(--accent-color)", "font-size": "18px"}, 
@@ -313,17 +598,38 @@ with st.sidebar:
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
-# Initialize quiz scoring
-if "quiz_score" not in st.session_state:
-    st.session_state.quiz_score = {"correct": 0, "total": 0}
+# Only the most recent messages are rendered; "load earlier" adds a page at a time
+if "qa_history_window" not in st.session_state:
+    st.session_state.qa_history_window = QA_HISTORY_PAGE_SIZE
+
+# Persisted conversation bookkeeping (a reset starts a new conversation, not a reload)
+if "qa_conversation_id" not in st.session_state:
+    st.session_state.qa_conversation_id = None
+if "qa_next_seq" not in st.session_state:
+    st.session_state.qa_next_seq = 0
+if "qa_has_earlier" not in st.session_state:
+    st.session_state.qa_has_earlier = False
+if "qa_history_loaded" not in st.session_state:
+    st.session_state.qa_history_loaded = False
+# Reloaded history doesn't count: the student's first question this session is still a fresh start
+if "qa_asked_this_session" not in st.session_state:
+    st.session_state.qa_asked_this_session = False
+
+# Bounded Q&A context: recent turns verbatim, older turns summarized in the background
+QA_RECENT_TURNS = 6
+QA_TOKEN_BUDGET = 4000
+
+if "qa_context" not in st.session_state:
+    st.session_state.qa_context = ConversationContext(
+        client, recent_turns=QA_RECENT_TURNS, token_budget=QA_TOKEN_BUDGET
+    )
 
-# Initialize flashcard scoring
-if "flashcard_score" not in st.session_state:
-    st.session_state.flashcard_score = {"got_it": 0, "missed": 0}
+# Initialize Q&A streaming preference and latency metrics
+if "stream_answers" not in st.session_state:
+    st.session_state.stream_answers = True
 
-# get today's date as a string
-def get_today_str():
-    return datetime.datetime.now().strftime("%Y-%m-%d")
+if "qa_latency" not in st.session_state:
+    st.session_state.qa_latency = {"ttft": [], "total": []}
 
 # Load or initialize usage tracking
 if "usage" not in st.session_state:
@@ -346,26 +652,35 @@ if st.session_state.usage.get("last_reset") != today_str:
         "limit_hit": {"qa": False, "quiz": False, "flashcard": False}
     })
 
-# Load usage from Firestore (once, after login)
-if current_user and "usage_loaded" not in st.session_state:
-    user_doc = db.collection("users").document(current_user).get()
-    if user_doc.exists:
-        usage_data = user_doc.to_dict().get("daily_usage", {})
-        if usage_data.get("last_reset") == today_str:
-            st.session_state.usage.update(usage_data)
-    st.session_state.usage_loaded = True
-
-# Persist usage back to Firestore when modified
-def save_usage():
-    if current_user:
-        db.collection("users").document(current_user).set(
-            {"daily_usage": st.session_state.usage}, merge=True
-        )
+# Load today's counters from Firestore (once per session per day)
+if current_user and st.session_state.get("usage_loaded") != today_str:
+    st.session_state.usage.update(usage_meter.load(current_user, today_str))
+    token_meter.load(current_user, today_str)
+    st.session_state.usage_loaded = today_str
+
+# Claim a usage slot atomically before generating; hand it back if generation fails
+def reserve_usage(mode):
+    limit = None if st.session_state.is_pro else DAILY_LIMITS[mode]
+    allowed, count = usage_meter.try_reserve(current_user, mode, today_str, limit=limit)
+    field = f"{mode}_count"
+    if count is None:
+        st.session_state.usage[field] += 1
+    else:
+        st.session_state.usage[field] = count
+    if not allowed:
+        st.session_state.usage["limit_hit"][mode] = True
+    return allowed
+
+def release_usage(mode):
+    # Called from except blocks: a failed release must not hide the error being handled.
+    # The span for usage.release already records the failure.
+    try:
+        usage_meter.release(current_user, mode, today_str)
+    except Exception:
+        pass
+    st.session_state.usage[f"{mode}_count"] = max(0, st.session_state.usage[f"{mode}_count"] - 1)
 
 def show_upgrade_modal(mode):
-    # Create a Stripe Checkout URL based on logged-in user email
-    upgrade_url = create_checkout_session(current_user)
-
     st.markdown(f"""
     <div style="background-color: var(--form-bg); padding: 2rem; border: 2px solid var(--accent-color); border-radius: 1rem; box-shadow: 0 4px 8px var(--shadow-color); margin: 2rem 0;">
         <h2 style="color: var(--text-primary);">🚀 Upgrade to Tutor Pro</h2>
@@ -379,30 +694,228 @@ def show_upgrade_modal(mode):
             <li>✅ Premium topics & smart review</li>
             <li>✅ Bonus: early access to mobile app</li>
         </ul>
-        {"<a href='" + upgrade_url + "' target='_blank'>" if upgrade_url else ""}
-            <button style="background-color: var(--button-bg); color: var(--button-text); padding: 0.8rem 1.5rem; font-size: 1.1rem; border: none; border-radius: 8px; cursor: pointer;">
-                🔓 Upgrade Now
-            </button>
-        {"</a>" if upgrade_url else ""}
     </div>
     """, unsafe_allow_html=True)
 
+    # Only talk to Stripe once the user actually asks to upgrade
+    upgrade_url = get_checkout_url(current_user, create=False)
+    if upgrade_url is None and st.button("🔓 Upgrade Now", key=f"upgrade_{mode}", use_container_width=True):
+        with st.spinner("💳 Preparing secure checkout..."):
+            upgrade_url = get_checkout_url(current_user)
+
+    if upgrade_url:
+        st.link_button("💳 Continue to secure checkout", upgrade_url, use_container_width=True)
+
+
+
+
+# Render a single chat bubble
+def render_message_html(role, content):
+    # No leading indentation: bubbles are concatenated, and indented lines would render as code.
+    # Content is escaped: the whole window is one element, so a stray "<table>" in one message
+    # would otherwise swallow every bubble after it.
+    content = html.escape(content)
+    if role == "user":
+        return (
+            '<div class="user-message-bubble">\n'
+            f"<strong>🧑‍🎓 You:</strong> {content}\n"
+            "</div>\n\n"
+        )
+    return (
+        '<div class="tutor-message-bubble">\n'
+        f"<strong>🤖 AI Tutor:</strong> {content}\n"
+        "</div>\n\n"
+    )
+
+# Q&A conversation persistence
+def load_active_conversation():
+    """Reopen the user's last conversation, fetching only its most recent page"""
+    st.session_state.qa_history_loaded = True
+    conversation_id = load_user_doc(current_user).get("active_conversation")
+    if not conversation_id or st.session_state.messages:
+        return
+
+    page = conversation_store.load_page(current_user, conversation_id)
+    st.session_state.qa_conversation_id = conversation_id
+    st.session_state.messages = page
+    st.session_state.qa_next_seq = page[-1]["seq"] + 1 if page else 0
+    st.session_state.qa_has_earlier = bool(page) and page[0]["seq"] > 0
+
+def load_earlier_messages():
+    """Prepend the page of stored messages just before the oldest one in memory"""
+    page = conversation_store.load_page(
+        current_user, st.session_state.qa_conversation_id,
+        before_seq=st.session_state.messages[0]["seq"]
+    )
+    st.session_state.messages[:0] = page
+    st.session_state.qa_context.skip_prepended(len(page))
+    st.session_state.qa_has_earlier = bool(page) and page[0]["seq"] > 0
+
+def persist_turn(turn_messages):
+    """Number a finished turn's messages and write them to Firestore in one background batch"""
+    new_conversation = st.session_state.qa_conversation_id is None
+    if new_conversation:
+        st.session_state.qa_conversation_id = conversation_store.new_conversation_id(current_user)
+        update_user_doc_cache(current_user, {"active_conversation": st.session_state.qa_conversation_id})
+
+    for message in turn_messages:
+        message["seq"] = st.session_state.qa_next_seq
+        st.session_state.qa_next_seq += 1
+
+    conversation_store.append(
+        current_user, st.session_state.qa_conversation_id, turn_messages,
+        new_conversation=new_conversation
+    )
+
+# Track Q&A latency (seconds) for the current session
+QA_LATENCY_WINDOW = 50
 
+def record_qa_latency(ttft, total):
+    latency = st.session_state.qa_latency
+    latency["ttft"].append(ttft)
+    latency["total"].append(total)
+    del latency["ttft"][:-QA_LATENCY_WINDOW]
+    del latency["total"][:-QA_LATENCY_WINDOW]
+
+
+def user_tier():
+    return "pro" if st.session_state.get("is_pro") else "free"
 
 
 # Define daily free usage caps
 DAILY_LIMITS = {
     "qa": 5,
     "quiz": 3,
-    "flashcard": 5
+    "flashcard": 5  # generated decks of FLASHCARD_DECK_SIZE cards
+}
+
+# Daily token budgets per tier, in billable tokens (see token_meter.py). The limits above count
+# requests; these bound what they cost, since a long Q&A turn can use 10x a short one.
+# Past "soft" the student is warned; past "hard" no new model calls are made until tomorrow.
+DAILY_TOKEN_BUDGETS = {
+    "free": {"soft": 40_000, "hard": 50_000},
+    "pro": {"soft": 800_000, "hard": 1_000_000},
 }
 
+def token_budget_state():
+    """("ok" | "soft" | "hard", share of the hard cap used) for the current user today"""
+    budget = DAILY_TOKEN_BUDGETS[user_tier()]
+    used = token_meter.used(current_user, today_str)["billable"]
+    if used >= budget["hard"]:
+        state = "hard"
+    elif used >= budget["soft"]:
+        state = "soft"
+    else:
+        state = "ok"
+    return state, used / budget["hard"]
+
+def show_token_budget_notice(mode, state, share):
+    if state == "soft":
+        st.warning(f"⚠️ You've used {share:.0%} of today's AI usage budget.")
+    elif state == "hard":
+        if st.session_state.is_pro:
+            st.error("🛑 You've reached today's AI usage budget. It resets tomorrow.")
+        else:
+            show_upgrade_modal(mode)
+
+
+# ============================================================================
+# ADMIN: CALL LATENCY
+# ============================================================================
+
+# Hidden page (open the app with ?admin=1) for the comma-separated emails in TUTOR_ADMIN_EMAILS
+ADMIN_EMAILS = {email.strip().lower() for email in os.getenv("TUTOR_ADMIN_EMAILS", "").split(",") if email.strip()}
+show_admin_page = st.query_params.get("admin") == "1" and current_user.lower() in ADMIN_EMAILS
+
+def latency_rows(group_by):
+    """One row per span group, slowest p95 first"""
+    rows = []
+    for key, stats in TELEMETRY.summary(group_by).items():
+        rows.append({
+            **dict(zip(group_by, key)),
+            "calls": stats["count"],
+            "errors": stats["errors"],
+            "p50_ms": round(stats["p50"] * 1000, 1),
+            "p95_ms": round(stats["p95"] * 1000, 1),
+        })
+    return sorted(rows, key=lambda row: row["p95_ms"], reverse=True)
+
+if show_admin_page:
+    st.markdown("""
+        <div class="page-header">
+            <h1>📈 Call Latency</h1>
+            <p>Model, Firestore and Stripe calls made by this server process</p>
+        </div>
+    """, unsafe_allow_html=True)
+
+    spans = TELEMETRY.spans()
+    st.caption(f"🧮 {len(spans)} most recent calls (buffer holds {TELEMETRY.capacity})")
+
+    if not spans:
+        st.info("No calls recorded yet.")
+    else:
+        st.markdown("#### ⏱️ By mode")
+        st.dataframe(latency_rows(("kind", "name", "mode")), use_container_width=True)
+
+        st.markdown("#### 🎯 By topic")
+        st.dataframe(latency_rows(("kind", "name", "topic")), use_container_width=True)
+
+        st.markdown("#### 🧾 Model tokens")
+        st.dataframe(
+            [{"model": model, **fields} for model, fields in TELEMETRY.token_totals().items()],
+            use_container_width=True
+        )
+
+        # Process totals from the model service, not just the buffered window
+        st.markdown("#### 🗃️ Prompt cache")
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Hit rate", f"{model_service.cache_hit_rate():.0%}")
+        col2.metric("Cache reads", f"{model_service.token_stats['cache_read_input_tokens']:,}")
+        col3.metric("Cache writes", f"{model_service.token_stats['cache_creation_input_tokens']:,}")
+
+        failed = [call for call in spans if call.error][-20:]
+        if failed:
+            st.markdown("#### ❌ Recent errors")
+            st.dataframe([
+                {"kind": call.kind, "name": call.name, "error": call.error,
+                 "ms": round(call.duration * 1000, 1), **call.attributes}
+                for call in reversed(failed)
+            ], use_container_width=True)
+
+    # Shared background calls (quiz pool refills) aren't in any student's budget
+    token_meter.load(SYSTEM_ACCOUNT, today_str)
+    system_usage = token_meter.used(SYSTEM_ACCOUNT, today_str)
+    st.markdown("#### 🏭 Shared background usage today")
+    st.caption(
+        f"🪙 {system_usage['billable']:,.0f} billable tokens · ~${system_usage['cost_usd']:.4f} estimated"
+    )
+    if system_usage["modes"]:
+        st.dataframe(
+            [{"mode": mode, **fields} for mode, fields in system_usage["modes"].items()],
+            use_container_width=True
+        )
+
+    prometheus_text = TELEMETRY.prometheus_text(gauges=[
+        ("tutor_prompt_cache_hit_ratio", "Share of prompt tokens read from the prompt cache since start.",
+         f"{model_service.cache_hit_rate():.6f}"),
+        *((f"tutor_model_service_{field}", f"Model {field.replace('_', ' ')} since start.", count)
+          for field, count in model_service.token_stats.items()),
+    ])
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("⬇️ Prometheus metrics", prometheus_text, file_name="metrics.prom",
+                           mime="text/plain", use_container_width=True)
+    with col2:
+        st.download_button("⬇️ OTLP spans (JSON)", TELEMETRY.otlp_json(), file_name="spans.json",
+                           mime="application/json", use_container_width=True)
+    with st.expander("Prometheus text"):
+        st.code(prometheus_text, language="text")
 
 # ============================================================================
 # Q&A CHAT MODE
 # ============================================================================
 
-if selected_mode == "Q&A Chat":
+elif selected_mode == "Q&A Chat":
     # Header section
     st.markdown(f"""
         <div class="page-header">
@@ -413,6 +926,10 @@ if selected_mode == "Q&A Chat":
     
     st.markdown("---")
 
+    # Reopen the stored conversation the first time Q&A is shown this session
+    if not st.session_state.qa_history_loaded:
+        load_active_conversation()
+
     # ---------------- TOPIC SELECTION UI ----------------
 
     # Core and extended topics
@@ -478,6 +995,8 @@ if selected_mode == "Q&A Chat":
 
 
 
+    set_tags(mode="qa", topic=st.session_state.selected_topic)
+
     # Chat input form
     with st.form(key="chat_input_form", clear_on_submit=True):
         user_question = st.text_input(
@@ -490,66 +1009,195 @@ if selected_mode == "Q&A Chat":
         with col2:
             submit_question = st.form_submit_button("🚀 Ask Tutor", use_container_width=True)
 
+    st.toggle("⚡ Stream answers as they are written", key="stream_answers")
+
     # Process user input
-    if not st.session_state.is_pro and st.session_state.usage["qa_count"] >= DAILY_LIMITS["qa"]:
+    qa_budget_state, qa_budget_share = token_budget_state()
+    if qa_budget_state == "hard":
+        show_token_budget_notice("Q&A", qa_budget_state, qa_budget_share)
+    elif not st.session_state.is_pro and st.session_state.usage["qa_count"] >= DAILY_LIMITS["qa"]:
         st.session_state.usage["limit_hit"]["qa"] = True
         show_upgrade_modal("Q&A")
     elif submit_question and user_question.strip():
-        st.session_state.usage["qa_count"] += 1
-        save_usage()
-
+        question = user_question.strip()
+
+        # The session's first question can be answered from the shared cache without a model call;
+        # later ones may lean on what was just discussed. Answers are only stored when no earlier
+        # history (reloaded or not) went into them.
+        is_first_turn = not st.session_state.qa_asked_this_session
+        starts_conversation = not st.session_state.messages
+        st.session_state.qa_asked_this_session = True
+        cached_answer = None
+        if is_first_turn:
+            cached_answer = response_cache.get(st.session_state.selected_topic, question)
 
         # Add user message to conversation
         st.session_state.messages.append({
             "role": "user", 
-            "content": user_question.strip()
+            "content": question
         })
 
-        # Generate AI response with topic-injected context
-        with st.spinner("🤔 Tutor is thinking..."):
+        if cached_answer is not None:
+            st.session_state.messages.append({
+                "role": "assistant", 
+                "content": cached_answer
+            })
+            persist_turn(st.session_state.messages[-2:])
+            st.caption("♻️ Answered instantly from a previously asked question (doesn't count toward your limit)")
+        else:
+            # Claim the slot atomically up front (another tab may have used it) and hand it back on failure
+            if not reserve_usage("qa"):
+                st.session_state.messages.pop()
+                st.rerun()
+
+            # Generate AI response with topic-injected context
+            topic_context = f"You are a tutor helping with the subject: {st.session_state.selected_topic}."
+            system_prompt, messages = st.session_state.qa_context.build(
+                st.session_state.messages, system=topic_context
+            )
+            # Short factual questions get a smaller budget; Pro explanations get the stronger model
+            qa_route = pick_route("qa", user_tier(), classify_question(question))
+
+            # Once the conversation is long enough to cache, everything before the new question is
+            # marked, but only while the prefix is the same as last turn's: a fresh summary or trim
+            # changes it, and a cache write for it would likely never be read back.
+            # ConversationContext only makes those changes every few turns.
+            if st.session_state.qa_context.prefix_stable:
+                cached_messages = cache_conversation_prefix(messages, system_prompt)
+            else:
+                cached_messages = messages
+            request_kwargs = {
+                "model": qa_route.model,
+                "system": system_prompt,
+                "max_tokens": qa_route.max_tokens,
+                "temperature": 0.6,
+                "messages": cached_messages,
+            }
+
             try:
-                topic_context = f"You are a tutor helping with the subject: {st.session_state.selected_topic}."
-                messages = [
-                    {"role": msg["role"], "content": msg["content"]}
-                    for msg in st.session_state.messages
-                ]
-                ai_response = client.messages.create(
-                    model="claude-3-haiku-20240307",
-                    system=topic_context,
-                    max_tokens=750,
-                    temperature=0.6,
-                    messages=messages
-                )
+                request_start = time.perf_counter()
+                first_token_at = None
+                tutor_answer = ""
+
+                if st.session_state.stream_answers:
+                    # Render partial text into the tutor bubble as tokens arrive
+                    answer_placeholder = st.empty()
+                else:
+                    answer_placeholder = None
+
+                while True:
+                    if answer_placeholder is not None:
+                        with client.messages.stream(**request_kwargs) as stream:
+                            for text in stream.text_stream:
+                                if first_token_at is None:
+                                    first_token_at = time.perf_counter()
+                                tutor_answer += text
+                                answer_placeholder.markdown(
+                                    render_message_html("assistant", tutor_answer + " ▌"),
+                                    unsafe_allow_html=True
+                                )
+                            ai_response = stream.get_final_message()
+                    else:
+                        with st.spinner("🤔 Tutor is thinking..."):
+                            ai_response = client.messages.create(**request_kwargs)
+                        tutor_answer += "".join(
+                            block.text for block in ai_response.content if block.type == "text"
+                        )
+
+                    # A cut-off answer continues from where it stopped on the next route up
+                    qa_route = escalate(qa_route) if ai_response.stop_reason == "max_tokens" else None
+                    if qa_route is None:
+                        break
+                    tutor_answer = tutor_answer.rstrip()
+                    request_kwargs.update(
+                        model=qa_route.model,
+                        max_tokens=qa_route.max_tokens,
+                        messages=cached_messages + [
+                            {"role": "assistant", "content": tutor_answer}
+                        ]
+                    )
 
+                if answer_placeholder is not None:
+                    # The full answer is shown in the history below
+                    answer_placeholder.empty()
+
+                st.session_state.qa_last_usage = ai_response.usage
+
+                finished_at = time.perf_counter()
+                record_qa_latency(
+                    ttft=(first_token_at or finished_at) - request_start,
+                    total=finished_at - request_start
+                )
 
-                tutor_answer = ai_response.content[0].text
                 st.session_state.messages.append({
                     "role": "assistant", 
                     "content": tutor_answer
                 })
+                persist_turn(st.session_state.messages[-2:])
+
+                if starts_conversation:
+                    response_cache.put(
+                        st.session_state.selected_topic, question, tutor_answer,
+                        generation_seconds=finished_at - request_start
+                    )
 
             except Exception as e:
+                release_usage("qa")
                 st.error(f"❌ Error generating response: {str(e)}")
 
+    # Latency the student actually feels: time to first token
+    if st.session_state.qa_latency["ttft"]:
+        last_ttft = st.session_state.qa_latency["ttft"][-1]
+        last_total = st.session_state.qa_latency["total"][-1]
+        avg_ttft = sum(st.session_state.qa_latency["ttft"]) / len(st.session_state.qa_latency["ttft"])
+        st.caption(
+            f"⚡ First token in {last_ttft:.2f}s · full answer in {last_total:.2f}s "
+            f"· session avg first token {avg_ttft:.2f}s"
+        )
+
+    if qa_budget_state == "soft":
+        show_token_budget_notice("Q&A", qa_budget_state, qa_budget_share)
+
+    # Prompt-cache effect on the most recent answer
+    last_usage = st.session_state.get("qa_last_usage")
+    if last_usage is not None:
+        st.caption(
+            f"🧾 Last answer: {last_usage.input_tokens} new input tokens · "
+            f"{last_usage.cache_read_input_tokens or 0} read from prompt cache · "
+            f"{last_usage.cache_creation_input_tokens or 0} written to prompt cache "
+            f"· {token_meter.used(current_user, today_str)['billable']:,.0f} billable tokens today"
+        )
 
+    # Shared answer cache effectiveness across all students in this process
+    cache_summary = response_cache.summary()
+    if cache_summary["hits"]:
+        st.caption(
+            f"♻️ Answer cache: {cache_summary['hit_rate']:.0%} hit rate over {cache_summary['lookups']} "
+            f"first questions · ~{cache_summary['seconds_saved']:.0f}s of generation saved "
+            f"· {cache_summary['avg_hit_ms']:.1f} ms per hit"
+        )
 
-    # Display conversation history
+    # Display conversation history (most recent window only, older pages on demand)
     if st.session_state.messages:
         st.markdown("### 💬 Conversation History")
-        
-        for message in st.session_state.messages:
-            if message["role"] == "user":
-                st.markdown(f"""
-                    <div class="user-message-bubble">
-                        <strong>🧑‍🎓 You:</strong> {message['content']}
-                    </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                    <div class="tutor-message-bubble">
-                        <strong>🤖 AI Tutor:</strong> {message['content']}
-                    </div>
-                """, unsafe_allow_html=True)
+
+        hidden_count = max(0, len(st.session_state.messages) - st.session_state.qa_history_window)
+        if hidden_count or st.session_state.qa_has_earlier:
+            if st.button("⬆️ Load earlier messages", use_container_width=True):
+                # Reveal what's already in memory first, then page older messages in from Firestore
+                if not hidden_count:
+                    load_earlier_messages()
+                st.session_state.qa_history_window += QA_HISTORY_PAGE_SIZE
+                st.rerun()
+
+        # Each bubble's HTML is built once and kept on the message; the window ships as one block
+        for message in st.session_state.messages[hidden_count:]:
+            if "html" not in message:
+                message["html"] = render_message_html(message["role"], message["content"])
+        st.markdown(
+            "".join(message["html"] for message in st.session_state.messages[hidden_count:]),
+            unsafe_allow_html=True
+        )
 
 # ============================================================================
 # QUIZ MODE
@@ -568,7 +1216,7 @@ elif selected_mode == "Quiz Mode":
     # ---------------- EXPANDABLE QUIZ TOPIC SELECTOR ----------------
     st.markdown("#### 🎯 Select a Quiz Topic")
 
-    core_quiz_topics = ["General", "Math", "Science", "History", "Programming"]
+    core_quiz_topics = CORE_QUIZ_TOPICS
     more_quiz_topics = ["Data Structures and Algorithms", "Java", "C", "Algebra", "Calculus", "Geography", "World History"]
 
     if "quiz_selected_topic" not in st.session_state:
@@ -615,135 +1263,116 @@ elif selected_mode == "Quiz Mode":
 
 
 
+    set_tags(mode="quiz", topic=st.session_state.quiz_selected_topic)
+
     # Initialize quiz state
     if "current_quiz_data" not in st.session_state:
         st.session_state.current_quiz_data = None
 
-    # Quiz generation controls
+    quiz_level = quiz_difficulty(
+        st.session_state.mastery["quiz"]["topics"].get(st.session_state.quiz_selected_topic)
+    )
+    st.caption(f"🎯 Difficulty: {quiz_level.title()} (adapts to your recent answers on this topic)")
+
+    # Quiz generation controls. Questions come from the shared pool, whose batches (cold topics
+    # included) are charged to the system account, so only the request limit applies here.
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
         if not st.session_state.is_pro and st.session_state.usage["quiz_count"] >= DAILY_LIMITS["quiz"]:
             st.session_state.usage["limit_hit"]["quiz"] = True
             show_upgrade_modal("Quiz")
         elif st.button("🎲 Generate New Question", use_container_width=True):
-            st.session_state.usage["quiz_count"] += 1
-            save_usage()
+            selected_quiz_topic = st.session_state.quiz_selected_topic
 
+            # Claim the slot atomically up front (another tab may have used it) and hand it back on failure
+            if not reserve_usage("quiz"):
+                st.rerun()
 
-            selected_quiz_topic = st.session_state.quiz_selected_topic
-            quiz_prompt = (
-                f"Create a multiple choice quiz question on the topic of '{selected_quiz_topic}'. "
-                "It should be suitable for students and formatted exactly as:\n\n"
-                "Format your response EXACTLY as follows:\n\n"
-                "**Question:** [Your question here]\n"
-                "**A.** [Option A]\n"
-                "**B.** [Option B]\n"
-                "**C.** [Option C]\n"
-                "**D.** [Option D]\n"
-                "**Answer:** [Letter only - A, B, C, or D]\n"
-                "**Explanation:** [Brief explanation of why this answer is correct]"
-            )
-            
+            # Served from the pre-generated pool; only a cold topic waits on the model
             with st.spinner("🔄 Generating new question..."):
                 try:
-                    quiz_response = client.messages.create(
-                        model="claude-3-haiku-20240307",
-                        max_tokens=600,
-                        temperature=0.8,
-                        messages=[{"role": "user", "content": quiz_prompt}]
-                    )
-                    
-                    st.session_state.current_quiz_data = quiz_response.content[0].text.strip()
-                    
+                    st.session_state.current_quiz_data = quiz_pool.take((selected_quiz_topic, quiz_level))
+                    st.session_state.current_quiz_topic = selected_quiz_topic
+                    st.session_state.quiz_shown_at = time.time()
+                    if st.session_state.current_quiz_data is None:
+                        release_usage("quiz")
+                        st.error("❌ Error generating quiz: no questions were returned. Please try again.")
+
                 except Exception as e:
+                    release_usage("quiz")
                     st.error(f"❌ Error generating quiz: {str(e)}")
 
     # Display and handle quiz
     if st.session_state.current_quiz_data:
-        try:
-            quiz_lines = st.session_state.current_quiz_data.split("\n")
-            
-            # Parse quiz components
-            quiz_question = ""
-            quiz_options = {}
-            correct_answer = ""
-            explanation = ""
-            
-            for line in quiz_lines:
-                line = line.strip()
-                if line.startswith("**Question:**"):
-                    quiz_question = line.replace("**Question:**", "").strip()
-                elif line.startswith("**A.**"):
-                    quiz_options["A"] = line.replace("**A.**", "").strip()
-                elif line.startswith("**B.**"):
-                    quiz_options["B"] = line.replace("**B.**", "").strip()
-                elif line.startswith("**C.**"):
-                    quiz_options["C"] = line.replace("**C.**", "").strip()
-                elif line.startswith("**D.**"):
-                    quiz_options["D"] = line.replace("**D.**", "").strip()
-                elif line.startswith("**Answer:**"):
-                    correct_answer = line.replace("**Answer:**", "").strip().upper()
-                elif line.startswith("**Explanation:**"):
-                    explanation = line.replace("**Explanation:**", "").strip()
-
-            # Display quiz question
-            if quiz_question and quiz_options:
-                st.markdown(f"""
-                    <div class="quiz-question-container">
-                        <h3>❓ {quiz_question}</h3>
-                    </div>
-                """, unsafe_allow_html=True)
-                
-                # Answer selection
-                user_selection = st.radio(
-                    "Select your answer:",
-                    list(quiz_options.keys()),
-                    format_func=lambda x: f"**{x}.** {quiz_options[x]}",
-                    key="quiz_answer_selection"
+        # Parsed once when generated; reruns just read the fields
+        quiz = st.session_state.current_quiz_data
+        quiz_options = quiz.options
+        correct_answer = quiz.answer
+        explanation = quiz.explanation
+
+        # Display quiz question
+        st.markdown(f"""
+            <div class="quiz-question-container">
+                <h3>❓ {quiz.question}</h3>
+            </div>
+        """, unsafe_allow_html=True)
+
+        # Answer selection
+        user_selection = st.radio(
+            "Select your answer:",
+            list(quiz_options.keys()),
+            format_func=lambda x: f"**{x}.** {quiz_options[x]}",
+            key="quiz_answer_selection"
+        )
+
+        # Submit answer
+        col1, col2, col3 = st.columns([1, 1, 1])
+        with col2:
+            if st.button("✅ Submit Answer", use_container_width=True):
+                is_correct = user_selection == correct_answer
+
+                # Log the answer and update this topic's aggregates
+                record_mastery(
+                    "quiz", st.session_state.current_quiz_topic, is_correct, latency_seconds=time.time() - st.session_state.quiz_shown_at
                 )
 
-                # Submit answer
-                col1, col2, col3 = st.columns([1, 1, 1])
-                with col2:
-                    if st.button("✅ Submit Answer", use_container_width=True):
-                        st.session_state.quiz_score["total"] += 1
-                        
-                        if user_selection == correct_answer:
-                            st.session_state.quiz_score["correct"] += 1
-
-                            # Save updated quiz score
-                            save_user_progress(current_user, "quiz_score", st.session_state.quiz_score)
-
-
-
-                            st.success(f"🎉 Correct! Well done!")
-                            if explanation:
-                                st.info(f"💡 **Explanation:** {explanation}")
-                        else:
-                            st.error(f"❌ Incorrect. The correct answer was **{correct_answer}**: {quiz_options.get(correct_answer, 'N/A')}")
-                            save_user_progress(current_user, "quiz_score", st.session_state.quiz_score)
-                            if explanation:
-                                st.info(f"💡 **Explanation:** {explanation}")
-                        
-                        # Clear current quiz after answering
-                        st.session_state.current_quiz_data = None
-                        
-        except Exception as e:
-            st.error("⚠️ Failed to parse quiz question. Please generate a new one.")
-            st.session_state.current_quiz_data = None
+                # Start filling the new level now so the next question doesn't wait on the model
+                new_level = quiz_difficulty(
+                    st.session_state.mastery["quiz"]["topics"][st.session_state.current_quiz_topic]
+                )
+                if new_level != quiz_level:
+                    quiz_pool.refill((st.session_state.current_quiz_topic, new_level))
+                    st.toast(f"🎯 Quiz difficulty is now {new_level.title()}")
+
+                if is_correct:
+                    st.success(f"🎉 Correct! Well done!")
+                    if explanation:
+                        st.info(f"💡 **Explanation:** {explanation}")
+                else:
+                    st.error(f"❌ Incorrect. The correct answer was **{correct_answer}**: {quiz_options.get(correct_answer, 'N/A')}")
+                    if explanation:
+                        st.info(f"💡 **Explanation:** {explanation}")
 
-    # Display quiz statistics
+                # Clear current quiz after answering
+                st.session_state.current_quiz_data = None
+
+    # Display quiz statistics (precomputed; nothing is recounted here)
     st.markdown("---")
-    total_questions = st.session_state.quiz_score["total"]
-    correct_answers = st.session_state.quiz_score["correct"]
-    
-    if total_questions > 0:
-        accuracy_percentage = (correct_answers / total_questions) * 100
+    quiz_overall = st.session_state.mastery["quiz"]["overall"]
+    quiz_topic_stats = st.session_state.mastery["quiz"]["topics"].get(st.session_state.quiz_selected_topic)
+
+    if quiz_overall["attempts"] > 0:
+        topic_html = ""
+        if quiz_topic_stats:
+            topic_html = f"""
+                <p><strong>{st.session_state.quiz_selected_topic}:</strong> {quiz_topic_stats['correct']} / {quiz_topic_stats['attempts']} correct
+                · recent accuracy {quiz_topic_stats['rolling_accuracy'] * 100:.0f}%
+                · streak {quiz_topic_stats['streak']} (best {quiz_topic_stats['best_streak']})</p>"""
         st.markdown(f"""
             <div class="score-display">
                 <h3>📊 Your Quiz Performance</h3>
-                <p><strong>Score:</strong> {correct_answers} / {total_questions} correct</p>
-                <p><strong>Accuracy:</strong> {accuracy_percentage:.1f}%</p>
+                <p><strong>Score:</strong> {quiz_overall['correct']} / {quiz_overall['attempts']} correct</p>
+                <p><strong>Accuracy:</strong> {quiz_overall['accuracy'] * 100:.1f}%</p>{topic_html}
             </div>
         """, unsafe_allow_html=True)
     else:
@@ -818,122 +1447,144 @@ elif selected_mode == "Flashcards":
         st.session_state.current_flashcard_data = None
     if "show_flashcard_answer" not in st.session_state:
         st.session_state.show_flashcard_answer = False
+    if "flashcard_decks" not in st.session_state:
+        st.session_state.flashcard_decks = {}
+
+    selected_flashcard_topic = st.session_state.flashcard_selected_topic
+    set_tags(mode="flashcard", topic=selected_flashcard_topic)
+    # Cards already reviewed come back when due, before any new (model-generated) cards
+    due_flashcard = review_scheduler.next_due(current_user, selected_flashcard_topic)
+    if due_flashcard is not None:
+        st.caption(
+            f"🔁 {review_scheduler.due_count(current_user, selected_flashcard_topic)} card(s) due for review "
+            "in this topic (reviews don't count toward your limit)"
+        )
+
+    # Cards left in this topic's deck are already paid for; only generating a new deck is held to
+    # the daily limit and the token budget
+    flashcard_budget_state, flashcard_budget_share = token_budget_state()
+    needs_new_deck = due_flashcard is None and not st.session_state.flashcard_decks.get(selected_flashcard_topic)
+
+    if needs_new_deck and flashcard_budget_state == "soft":
+        show_token_budget_notice("Flashcards", flashcard_budget_state, flashcard_budget_share)
 
     # Flashcard generation
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
-        if not st.session_state.is_pro and st.session_state.usage["flashcard_count"] >= DAILY_LIMITS["flashcard"]:
+        if needs_new_deck and flashcard_budget_state == "hard":
+            show_token_budget_notice("Flashcards", flashcard_budget_state, flashcard_budget_share)
+        elif (needs_new_deck and not st.session_state.is_pro
+                and st.session_state.usage["flashcard_count"] >= DAILY_LIMITS["flashcard"]):
             st.session_state.usage["limit_hit"]["flashcard"] = True
             show_upgrade_modal("Flashcards")
         elif st.button("🔄 New Flashcard", use_container_width=True):
-            st.session_state.usage["flashcard_count"] += 1
-            save_usage()
+            if due_flashcard is not None:
+                st.session_state.current_flashcard_data = due_flashcard
+                st.session_state.show_flashcard_answer = False
+            else:
+                deck = st.session_state.flashcard_decks.setdefault(selected_flashcard_topic, [])
+
+                # New cards come from this user's deck; only an empty deck costs a model call (and a usage slot)
+                if not deck:
+                    # Claim the slot atomically up front (another tab may have used it) and hand it back on failure
+                    if not reserve_usage("flashcard"):
+                        st.rerun()
+
+                    with st.spinner("📚 Creating new flashcards..."):
+                        try:
+                            deck.extend(generate_flashcard_deck(selected_flashcard_topic, user_tier()))
+                            if not deck:
+                                release_usage("flashcard")
+                                st.error("❌ Error creating flashcard: no cards were returned. Please try again.")
+                        except Exception as e:
+                            release_usage("flashcard")
+                            st.error(f"❌ Error creating flashcard: {str(e)}")
+
+                if deck:
+                    st.session_state.current_flashcard_data = deck.pop(0)
+                    st.session_state.show_flashcard_answer = False
 
+            if st.session_state.current_flashcard_data is not None:
+                st.session_state.current_flashcard_topic = selected_flashcard_topic
+                st.session_state.flashcard_shown_at = time.time()
 
-            flashcard_prompt = (
-                "Create an educational flashcard for a student studying computer science, "
-                "mathematics, or general academic subjects. "
-                "Format your response EXACTLY as follows:\n\n"
-                "**Question:** [Clear, concise question]\n"
-                "**Answer:** [Comprehensive answer with explanation]"
-            )
-            
-            with st.spinner("📚 Creating new flashcard..."):
-                try:
-                    flashcard_response = client.messages.create(
-                        model="claude-3-haiku-20240307",
-                        max_tokens=400,
-                        temperature=0.6,
-                        messages=[{"role": "user", "content": flashcard_prompt}]
+    # Display flashcard
+    if st.session_state.current_flashcard_data:
+        flashcard = st.session_state.current_flashcard_data
+
+        # Display question
+        review_label = " (review)" if isinstance(flashcard, ReviewCard) else ""
+        st.markdown(f"""
+            <div class="flashcard-container">
+                <div class="flashcard-question">
+                    <h3>🤔 Question{review_label}</h3>
+                    <p>{flashcard.question}</p>
+                </div>
+            </div>
+        """, unsafe_allow_html=True)
+
+        # Show/hide answer controls
+        if not st.session_state.show_flashcard_answer:
+            col1, col2, col3 = st.columns([1, 1, 1])
+            with col2:
+                if st.button("👁️ Reveal Answer", use_container_width=True):
+                    st.session_state.show_flashcard_answer = True
+                    st.rerun()
+        else:
+            # Display answer
+            st.markdown(f"""
+                <div class="flashcard-answer">
+                    <h3>✅ Answer</h3>
+                    <p>{flashcard.answer}</p>
+                </div>
+            """, unsafe_allow_html=True)
+
+            st.markdown("### 📊 How did you do?")
+
+            # Self-assessment buttons
+            col1, col2 = st.columns(2)
+
+            with col1:
+                if st.button("✅ Got it right!", use_container_width=True):
+                    record_mastery(
+                        "flashcard", st.session_state.current_flashcard_topic, True, latency_seconds=time.time() - st.session_state.flashcard_shown_at
                     )
-                    
-                    st.session_state.current_flashcard_data = flashcard_response.content[0].text.strip()
+                    scheduled = review_scheduler.review(
+                        current_user, st.session_state.current_flashcard_topic, flashcard, GRADE_GOOD
+                    )
+                    st.success(f"Great job! 🎉 See you again in {scheduled.interval_days} day(s).")
+                    st.session_state.current_flashcard_data = None
                     st.session_state.show_flashcard_answer = False
-                    
-                except Exception as e:
-                    st.error(f"❌ Error creating flashcard: {str(e)}")
 
-    # Display flashcard
-    if st.session_state.current_flashcard_data:
-        try:
-            card_lines = st.session_state.current_flashcard_data.split("\n")
-            
-            flashcard_question = ""
-            flashcard_answer = ""
-            
-            for line in card_lines:
-                line = line.strip()
-                if line.startswith("**Question:**"):
-                    flashcard_question = line.replace("**Question:**", "").strip()
-                elif line.startswith("**Answer:**"):
-                    flashcard_answer = line.replace("**Answer:**", "").strip()
-
-            if flashcard_question:
-                # Display question
-                st.markdown(f"""
-                    <div class="flashcard-container">
-                        <div class="flashcard-question">
-                            <h3>🤔 Question</h3>
-                            <p>{flashcard_question}</p>
-                        </div>
-                    </div>
-                """, unsafe_allow_html=True)
-
-                # Show/hide answer controls
-                if not st.session_state.show_flashcard_answer:
-                    col1, col2, col3 = st.columns([1, 1, 1])
-                    with col2:
-                        if st.button("👁️ Reveal Answer", use_container_width=True):
-                            st.session_state.show_flashcard_answer = True
-                            st.rerun()
-                else:
-                    # Display answer
-                    st.markdown(f"""
-                        <div class="flashcard-answer">
-                            <h3>✅ Answer</h3>
-                            <p>{flashcard_answer}</p>
-                        </div>
-                    """, unsafe_allow_html=True)
-                    
-                    st.markdown("### 📊 How did you do?")
-                    
-                    # Self-assessment buttons
-                    col1, col2 = st.columns(2)
-                    
-                    with col1:
-                        if st.button("✅ Got it right!", use_container_width=True):
-                            st.session_state.flashcard_score["got_it"] += 1
-                            save_user_progress(current_user, "flashcard_score", st.session_state.flashcard_score)
-                            st.success("Great job! 🎉")
-                            st.session_state.current_flashcard_data = None
-                            st.session_state.show_flashcard_answer = False
-                    
-                    with col2:
-                        if st.button("❌ Need more practice", use_container_width=True):
-                            st.session_state.flashcard_score["missed"] += 1
-                            save_user_progress(current_user, "flashcard_score", st.session_state.flashcard_score)                   
-                            st.info("No worries, keep studying! 📚")
-                            st.session_state.current_flashcard_data = None
-                            st.session_state.show_flashcard_answer = False
-                            
-        except Exception as e:
-            st.error("⚠️ Failed to parse flashcard. Please generate a new one.")
-            st.session_state.current_flashcard_data = None
+            with col2:
+                if st.button("❌ Need more practice", use_container_width=True):
+                    record_mastery(
+                        "flashcard", st.session_state.current_flashcard_topic, False, latency_seconds=time.time() - st.session_state.flashcard_shown_at
+                    )
+                    review_scheduler.review(
+                        current_user, st.session_state.current_flashcard_topic, flashcard, GRADE_AGAIN
+                    )
+                    st.info("No worries, keep studying! 📚 This card will come back shortly.")
+                    st.session_state.current_flashcard_data = None
+                    st.session_state.show_flashcard_answer = False
 
-    # Display flashcard statistics
+    # Display flashcard statistics (precomputed; nothing is recounted here)
     st.markdown("---")
-    cards_correct = st.session_state.flashcard_score["got_it"]
-    cards_missed = st.session_state.flashcard_score["missed"]
-    total_cards = cards_correct + cards_missed
-    
-    if total_cards > 0:
-        success_rate = (cards_correct / total_cards) * 100
+    flashcard_overall = st.session_state.mastery["flashcard"]["overall"]
+    flashcard_topic_stats = st.session_state.mastery["flashcard"]["topics"].get(selected_flashcard_topic)
+
+    if flashcard_overall["attempts"] > 0:
+        topic_html = ""
+        if flashcard_topic_stats:
+            topic_html = f"""
+                <p><strong>{selected_flashcard_topic}:</strong> recent success {flashcard_topic_stats['rolling_accuracy'] * 100:.0f}%
+                · streak {flashcard_topic_stats['streak']} (best {flashcard_topic_stats['best_streak']})</p>"""
         st.markdown(f"""
             <div class="score-display">
                 <h3>📈 Flashcard Progress</h3>
-                <p><strong>Cards mastered:</strong> {cards_correct}</p>
-                <p><strong>Cards to review:</strong> {cards_missed}</p>
-                <p><strong>Success rate:</strong> {success_rate:.1f}%</p>
+                <p><strong>Cards mastered:</strong> {flashcard_overall['correct']}</p>
+                <p><strong>Cards to review:</strong> {flashcard_overall['incorrect']}</p>
+                <p><strong>Success rate:</strong> {flashcard_overall['accuracy'] * 100:.1f}%</p>{topic_html}
             </div>
         """, unsafe_allow_html=True)
     else:
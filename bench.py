@@ -0,0 +1,236 @@
+"""Benchmarks for rerun latency and per-action backend cost, run on the local backend.
+
+    python bench.py                      # everything, JSON on stdout
+    python bench.py --only reruns css    # a subset
+    python bench.py --output results.json
+
+Measures cold start, idle rerun wall time per mode (Q&A at several history sizes), the cost
+of re-sending the theme CSS, quiz/flashcard parsing time and Firestore/model operations per
+click. Model latency is zeroed so the numbers are the app's own overhead.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from argparse import Namespace
+from collections import defaultdict
+from datetime import datetime, timezone
+
+os.environ.setdefault("TUTOR_BACKEND", "local")
+os.environ.setdefault("TUTOR_FAKE_MODEL_TTFT", "0")
+os.environ.setdefault("TUTOR_FAKE_MODEL_TPS", "1000000")
+
+import streamlit  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+from loadtest import APP_PATH, _button, run_session, summarize_profile  # noqa: E402
+from local_backend import LocalModelService  # noqa: E402
+from study_items import parse_flashcards, parse_quiz_questions  # noqa: E402
+
+BENCHMARKS = ("cold_start", "reruns", "css", "parsing", "backend_ops")
+
+
+def _summary(seconds):
+    ordered = sorted(seconds)
+    return {
+        "samples": len(ordered),
+        "mean_ms": round(statistics.mean(ordered) * 1000, 3),
+        "p50_ms": round(statistics.median(ordered) * 1000, 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+    }
+
+
+def _time_reruns(at, repeats):
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        at.run()
+        samples.append(time.perf_counter() - start)
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+    return samples
+
+
+def _logged_in_app(email, mode="Q&A Chat", **session_values):
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    at.session_state["user"] = {"email": email}
+    at.session_state["selected_mode"] = mode
+    for key, value in session_values.items():
+        at.session_state[key] = value
+    return at
+
+
+def probe_cold_start():
+    """Runs in a fresh interpreter: time the first (all caches cold) and second run"""
+    start = time.perf_counter()
+    at = _logged_in_app("cold@bench.local")
+    at.run()
+    first = time.perf_counter() - start
+
+    start = time.perf_counter()
+    at.run()
+    second = time.perf_counter() - start
+    print(json.dumps({"first_run": first, "second_run": second}))
+
+
+def bench_cold_start(samples):
+    first, second, process = [], [], []
+    for _ in range(samples):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--probe-cold-start"],
+            capture_output=True, text=True, check=True, env=os.environ.copy()
+        ).stdout
+        process.append(time.perf_counter() - start)
+        probe = json.loads(output.strip().splitlines()[-1])
+        first.append(probe["first_run"])
+        second.append(probe["second_run"])
+
+    return {
+        "process_start_to_exit": _summary(process),
+        "first_run": _summary(first),
+        "second_run": _summary(second),
+    }
+
+
+def _history(size):
+    return [
+        {
+            "seq": i,
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"Question {i // 2} about linked lists?" if i % 2 == 0 else "An answer paragraph. " * 30,
+        }
+        for i in range(size)
+    ]
+
+
+def bench_reruns(history_sizes, repeats):
+    results = []
+
+    # Q&A: the default window of recent messages, and the whole history after "load earlier"
+    for size in history_sizes:
+        for expanded in (False, True):
+            values = {"messages": _history(size), "qa_history_loaded": True, "qa_next_seq": size}
+            if expanded:
+                values["qa_history_window"] = max(size, 1)
+            at = _logged_in_app(f"qa{size}{'x' if expanded else ''}@bench.local", **values)
+            at.run()
+            results.append({
+                "mode": "qa", "history": size, "expanded": expanded, **_summary(_time_reruns(at, repeats))
+            })
+
+    # Quiz / flashcards with a question on screen
+    for mode, label, button in (("quiz", "Quiz Mode", "🎲 Generate New Question"),
+                                ("flashcards", "Flashcards", "🔄 New Flashcard")):
+        at = _logged_in_app(f"{mode}@bench.local", mode=label)
+        at.run()
+        at.session_state["selected_mode"] = label
+        _button(at, button).click()
+        at.run()
+
+        # The menu's value isn't kept between AppTest runs, so pin it for each one
+        samples = []
+        for _ in range(repeats):
+            at.session_state["selected_mode"] = label
+            samples.extend(_time_reruns(at, 1))
+        results.append({"mode": mode, "history": 0, "expanded": False, **_summary(samples)})
+
+    return results
+
+
+def bench_css(repeats):
+    at = _logged_in_app("css@bench.local")
+    at.run()
+    style = next(element.value for element in at.markdown if element.value.startswith("<style>"))
+
+    # Emitting the cached <style> block vs. an empty script isolates the per-rerun cost
+    emit = AppTest.from_string(f"import streamlit as st\nst.markdown({style!r}, unsafe_allow_html=True)\n")
+    empty = AppTest.from_string("import streamlit as st\n")
+    emit.run()
+    empty.run()
+    emit_summary = _summary(_time_reruns(emit, repeats))
+    empty_summary = _summary(_time_reruns(empty, repeats))
+
+    return {
+        "style_bytes": len(style.encode()),
+        "emit_rerun": emit_summary,
+        "empty_rerun": empty_summary,
+        "overhead_p50_ms": round(emit_summary["p50_ms"] - empty_summary["p50_ms"], 3),
+    }
+
+
+def bench_parsing(number):
+    quiz_input = LocalModelService._tool_input("record_quiz_questions", "Create 8 questions on 'Math'.")
+    card_input = LocalModelService._tool_input("record_flashcards", "Create 10 flashcards on 'Math'.")
+
+    results = {}
+    for name, parse, tool_input in (("quiz_batch_8", parse_quiz_questions, quiz_input),
+                                    ("flashcard_deck_10", parse_flashcards, card_input)):
+        best = min(timeit.repeat(lambda: parse(tool_input), number=number, repeat=5))
+        results[name] = {"us_per_call": round(best / number * 1e6, 3)}
+    return results
+
+
+def bench_backend_ops(settle):
+    args = Namespace(questions=3, quizzes=2, flashcards=3, timeout=60.0)
+    op_deltas = defaultdict(list)
+    errors = [error for _, _, error in run_session("bench", args, settle, op_deltas) if error]
+    if errors:
+        raise RuntimeError(errors[0])
+    return summarize_profile(op_deltas)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--repeats", type=int, default=20, help="reruns per measurement")
+    parser.add_argument("--history-sizes", type=int, nargs="+", default=[0, 20, 100, 500])
+    parser.add_argument("--cold-start-samples", type=int, default=3)
+    parser.add_argument("--settle", type=float, default=2.5,
+                        help="seconds to wait after each click before counting its ops (covers background writes)")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    parser.add_argument("--probe-cold-start", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe_cold_start:
+        probe_cold_start()
+        return
+
+    results = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                cwd=os.path.dirname(APP_PATH)
+            ).stdout.strip() or None,
+            "python": platform.python_version(),
+            "streamlit": streamlit.__version__,
+            "repeats": args.repeats,
+        }
+    }
+
+    if "cold_start" in args.only:
+        results["cold_start"] = bench_cold_start(args.cold_start_samples)
+    if "reruns" in args.only:
+        results["reruns"] = bench_reruns(args.history_sizes, args.repeats)
+    if "css" in args.only:
+        results["css"] = bench_css(args.repeats)
+    if "parsing" in args.only:
+        results["parsing"] = bench_parsing(number=2000)
+    if "backend_ops" in args.only:
+        results["backend_ops"] = bench_backend_ops(args.settle)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
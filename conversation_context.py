@@ -0,0 +1,169 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# Summaries are generated off the request path on a small shared pool
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="qa-summary")
+
+SUMMARY_MODEL = "claude-3-haiku-20240307"
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) used for budgeting"""
+    return max(1, len(text) // 4)
+
+
+class ConversationContext:
+    """Build bounded Q&A requests from an ever-growing conversation.
+
+    The last `recent_turns` user/assistant pairs are sent verbatim. Older turns are folded
+    into a running summary that is generated in the background and cached on this object,
+    and every request is trimmed to fit `token_budget` input tokens.
+
+    Both change the request's prefix (the summary is part of the system prompt), so both
+    happen in chunks: turns are folded `fold_turns` at a time, and trimming cuts down to
+    `trim_to` of the budget. In between, consecutive requests share a prefix the prompt
+    cache can reuse, and `prefix_stable` says whether the last `build` kept it.
+    """
+
+    def __init__(self, client, recent_turns=6, token_budget=4000, summary_max_tokens=300, trim_to=0.6,
+                 fold_turns=None):
+        self.client = client
+        self.recent_turns = recent_turns
+        self.token_budget = token_budget
+        self.summary_max_tokens = summary_max_tokens
+        self.trim_to = trim_to
+        self.fold_turns = fold_turns or recent_turns
+
+        self.summary = ""
+        # messages[:summarized_upto] are already represented by self.summary
+        self.summarized_upto = 0
+        # messages[:window_start] were trimmed to fit the budget
+        self.window_start = 0
+        self._pending = None
+        # (system prompt, window start) of the last request, and whether it matched the one before
+        self._last_prefix = None
+        self.prefix_stable = False
+
+    def reset(self):
+        self.summary = ""
+        self.summarized_upto = 0
+        self.window_start = 0
+        self._pending = None
+        self._last_prefix = None
+        self.prefix_stable = False
+
+    def skip_prepended(self, count):
+        """Account for `count` older messages inserted at the front of the conversation.
+
+        They were never part of this context, so they are treated as already summarized.
+        """
+        self.summarized_upto += count
+        self.window_start += count
+        if self._last_prefix is not None:
+            system_prompt, start = self._last_prefix
+            self._last_prefix = (system_prompt, start + count)
+        if self._pending is not None:
+            future, upto = self._pending
+            self._pending = (future, upto + count)
+
+    def build(self, messages, system=""):
+        """Return (system_prompt, request_messages) for the next model call"""
+        if len(messages) < max(self.summarized_upto, self.window_start):
+            # The conversation was cleared underneath us
+            self.reset()
+
+        self._collect_summary()
+
+        recent_start = max(0, len(messages) - self.recent_turns * 2)
+        # Never split a turn: the verbatim window starts on a student question
+        while recent_start > 0 and messages[recent_start]["role"] != "user":
+            recent_start -= 1
+        # Older turns wait until there are `fold_turns` of them, so the summary changes in steps
+        if recent_start - self.summarized_upto >= self.fold_turns * 2:
+            self._schedule_summary(messages, recent_start)
+
+        system_prompt = system
+        if self.summary:
+            system_prompt = (
+                f"{system}\n\nSummary of the earlier conversation with this student:\n{self.summary}"
+            ).strip()
+
+        # Turns not yet summarized stay verbatim until their summary is ready
+        start = max(self.summarized_upto, self.window_start)
+        window = [
+            {"role": msg["role"], "content": msg["content"]}
+            for msg in messages[start:]
+        ]
+        window, dropped = self._fit_budget(system_prompt, window)
+        self.window_start = start + dropped
+
+        prefix = (system_prompt, self.window_start)
+        self.prefix_stable = prefix == self._last_prefix
+        self._last_prefix = prefix
+        return system_prompt, window
+
+    def _fit_budget(self, system_prompt, window):
+        """Trim the window to the budget; returns it with the number of messages dropped"""
+        used = estimate_tokens(system_prompt) if system_prompt else 0
+        used += sum(estimate_tokens(msg["content"]) for msg in window)
+
+        # Drop the oldest messages first, but always keep the latest question. Cutting well below
+        # the budget leaves room for the next few turns without moving the start again.
+        dropped = 0
+        if used > self.token_budget:
+            target = self.token_budget * self.trim_to
+            while used > target and len(window) > 1:
+                used -= estimate_tokens(window.pop(0)["content"])
+                dropped += 1
+
+        # The API requires the conversation to open with a user turn
+        while len(window) > 1 and window[0]["role"] != "user":
+            window.pop(0)
+            dropped += 1
+
+        return window, dropped
+
+    def _schedule_summary(self, messages, upto):
+        if self._pending is not None:
+            return
+
+        folded = messages[self.summarized_upto:upto]
+        transcript = "\n".join(
+            f"{'Student' if msg['role'] == 'user' else 'Tutor'}: {msg['content']}"
+            for msg in folded
+        )
+        # Run in the caller's context so the summary call is attributed to its mode and topic
+        future = _summary_executor.submit(contextvars.copy_context().run, self._summarize, self.summary, transcript)
+        self._pending = (future, upto)
+
+    def _collect_summary(self):
+        if self._pending is None:
+            return
+
+        future, upto = self._pending
+        if not future.done():
+            return
+
+        self._pending = None
+        try:
+            self.summary = future.result()
+            self.summarized_upto = upto
+        except Exception:
+            # Keep sending the turns verbatim; we'll try again on the next question
+            pass
+
+    def _summarize(self, previous_summary, transcript):
+        prompt = (
+            "Update the running summary of a tutoring conversation. Keep the topics covered, "
+            "key facts and definitions the tutor gave, the student's level and any open questions. "
+            "Reply with the summary only, in under 150 words.\n\n"
+            f"Current summary:\n{previous_summary or '(none)'}\n\n"
+            f"New conversation turns:\n{transcript}"
+        )
+        response = self.client.messages.create(
+            model=SUMMARY_MODEL,
+            max_tokens=self.summary_max_tokens,
+            temperature=0.2,
+            messages=[{"role": "user", "content": prompt}]
+        )
+        return response.content[0].text.strip()
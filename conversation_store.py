@@ -0,0 +1,83 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import firestore
+
+from telemetry import traced
+
+
+class ConversationStore:
+    """Q&A conversations stored under users/{email}/conversations/{id}/messages/{seq}.
+
+    Messages are append-only and written one batch per turn in the background. History is
+    read back a page at a time, newest first, using the message `seq` as the query cursor.
+    """
+
+    def __init__(self, db, page_size=20, max_workers=4):
+        self.db = db
+        self.page_size = page_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="conversation-store")
+
+    def _conversation_ref(self, email, conversation_id):
+        return (
+            self.db.collection("users").document(email)
+            .collection("conversations").document(conversation_id)
+        )
+
+    def new_conversation_id(self, email):
+        """Allocate an id locally (no round trip); the documents are created with the first append"""
+        return self.db.collection("users").document(email).collection("conversations").document().id
+
+    def append(self, email, conversation_id, messages, new_conversation=False):
+        """Queue one batched write for a turn's messages; each message needs `seq`, `role` and `content`"""
+        return self._executor.submit(
+            contextvars.copy_context().run, self._append, email, conversation_id, messages, new_conversation
+        )
+
+    @traced("firestore", "conversation.append")
+    def _append(self, email, conversation_id, messages, new_conversation):
+        conversation_ref = self._conversation_ref(email, conversation_id)
+        batch = self.db.batch()
+
+        if new_conversation:
+            batch.set(
+                self.db.collection("users").document(email),
+                {"active_conversation": conversation_id},
+                merge=True
+            )
+
+        for message in messages:
+            batch.set(conversation_ref.collection("messages").document(f"{message['seq']:08d}"), {
+                "seq": message["seq"],
+                "role": message["role"],
+                "content": message["content"],
+                "created_at": firestore.SERVER_TIMESTAMP,
+            })
+
+        conversation = {
+            "message_count": firestore.Increment(len(messages)),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }
+        if new_conversation:
+            # Merged rather than a plain set, which would wipe a message_count another write already added
+            conversation["created_at"] = firestore.SERVER_TIMESTAMP
+        batch.set(conversation_ref, conversation, merge=True)
+        batch.commit()
+
+    @traced("firestore", "conversation.load_page")
+    def load_page(self, email, conversation_id, before_seq=None):
+        """Return up to one page of messages older than `before_seq`, oldest first"""
+        query = (
+            self._conversation_ref(email, conversation_id)
+            .collection("messages")
+            .order_by("seq", direction=firestore.Query.DESCENDING)
+        )
+        if before_seq is not None:
+            query = query.start_after({"seq": before_seq})
+
+        page = [
+            {"seq": data["seq"], "role": data["role"], "content": data["content"]}
+            for data in (doc.to_dict() for doc in query.limit(self.page_size).stream())
+        ]
+        page.reverse()
+        return page
@@ -0,0 +1,214 @@
+"""Drive app.py through simulated student sessions on the local backend (no network needed).
+
+    python loadtest.py --sessions 200 --concurrency 32
+
+Each session signs up, asks Q&A questions, answers quiz questions and reviews flashcards
+through Streamlit's AppTest, so every step is a real rerun of the script. One session is
+first profiled on its own to attribute backend operations to each action, then all
+sessions run concurrently to measure reruns/second.
+"""
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+# Must be set before app.py / firebase_config are imported by AppTest
+os.environ.setdefault("TUTOR_BACKEND", "local")
+
+from streamlit.runtime import Runtime  # noqa: E402
+from streamlit.runtime.media_file_manager import MediaFileManager  # noqa: E402
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage  # noqa: E402
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+from local_backend import snapshot_op_counts  # noqa: E402
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# AppTest installs a mock Runtime for each run and clears it when the run ends. With sessions
+# on several threads one run can clear it under another, so fall back to a shared mock.
+_shared_runtime = MagicMock(spec=Runtime)
+_shared_runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+Runtime.instance = classmethod(lambda cls: cls._instance or _shared_runtime)
+Runtime.exists = classmethod(lambda cls: True)
+
+# Each AppTest run also recompiles the script with a fresh ScriptCache, and concurrent
+# ast.parse calls can crash CPython 3.11. A server compiles once; so do we.
+_bytecode = {}
+_bytecode_lock = threading.Lock()
+_get_bytecode = ScriptCache.get_bytecode
+
+
+def _shared_get_bytecode(self, script_path):
+    with _bytecode_lock:
+        if script_path not in _bytecode:
+            _bytecode[script_path] = _get_bytecode(self, script_path)
+        return _bytecode[script_path]
+
+
+ScriptCache.get_bytecode = _shared_get_bytecode
+
+
+def _button(at, label):
+    return next(button for button in at.button if button.label == label)
+
+
+def _text_input(at, label):
+    return next(widget for widget in at.text_input if widget.label == label)
+
+
+def _in_mode(mode, action=None):
+    """The menu is a custom component AppTest can't click, and its value isn't kept between
+    runs, so the mode is set through session state before every rerun"""
+    def apply(at):
+        at.session_state["selected_mode"] = mode
+        if action is not None:
+            action(at)
+    return apply
+
+
+def session_steps(index, questions, quizzes, flashcards):
+    """Yield (action, apply) pairs; `apply(at)` sets up the widgets for the next rerun"""
+    email = f"student{index}@loadtest.local"
+
+    def sign_up(at):
+        _text_input(at, "📧 Email").set_value(email)
+        _text_input(at, "🔑 Password").set_value("loadtest-password")
+        _button(at, "📝 Sign Up").click()
+
+    yield "open_app", lambda at: None
+    yield "sign_up", sign_up
+
+    for i in range(questions):
+        def ask(at, i=i):
+            _text_input(at, "💭 Your Question").set_value(f"What is topic {i} in session {index}?")
+            _button(at, "🚀 Ask Tutor").click()
+        yield "ask_question", _in_mode("Q&A Chat", ask)
+
+    yield "open_quiz", _in_mode("Quiz Mode")
+    for _ in range(quizzes):
+        yield "generate_quiz", _in_mode("Quiz Mode", lambda at: _button(at, "🎲 Generate New Question").click())
+        yield "submit_answer", _in_mode("Quiz Mode", lambda at: _button(at, "✅ Submit Answer").click())
+
+    yield "open_flashcards", _in_mode("Flashcards")
+    for _ in range(flashcards):
+        yield "new_flashcard", _in_mode("Flashcards", lambda at: _button(at, "🔄 New Flashcard").click())
+        yield "reveal_answer", _in_mode("Flashcards", lambda at: _button(at, "👁️ Reveal Answer").click())
+        yield "rate_flashcard", _in_mode("Flashcards", lambda at: _button(at, "✅ Got it right!").click())
+
+
+def run_session(index, args, settle=0.0, op_deltas=None):
+    """Run one session; returns [(action, seconds, error)]"""
+    at = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+    results = []
+
+    for action, apply in session_steps(index, args.questions, args.quizzes, args.flashcards):
+        error = None
+        before = snapshot_op_counts() if op_deltas is not None else None
+        start = time.perf_counter()
+        try:
+            apply(at)
+            at.run()
+            if at.exception:
+                error = f"{action}: {at.exception[0].message}"
+        except Exception as e:
+            error = f"{action}: {type(e).__name__} {e}"
+        results.append((action, time.perf_counter() - start, error))
+
+        if op_deltas is not None:
+            # Let background writes (messages, mastery events) land before attributing ops
+            time.sleep(settle)
+            after = snapshot_op_counts()
+            op_deltas[action].append({kind: after.get(kind, 0) - before.get(kind, 0) for kind in after})
+        if error:
+            break
+
+    return results
+
+
+def summarize_profile(op_deltas):
+    return {
+        action: {kind: statistics.mean(delta.get(kind, 0) for delta in deltas) for kind in sorted(
+            {kind for delta in deltas for kind in delta}
+        )}
+        for action, deltas in op_deltas.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--questions", type=int, default=3, help="Q&A questions per session")
+    parser.add_argument("--quizzes", type=int, default=2, help="quiz questions per session")
+    parser.add_argument("--flashcards", type=int, default=3, help="flashcards per session")
+    parser.add_argument("--settle", type=float, default=2.5,
+                        help="seconds to wait after each profiled action (covers background writes)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds allowed per rerun")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    # 1. One session on its own, so every backend op can be pinned on the action that caused it
+    op_deltas = defaultdict(list)
+    profile_errors = [error for _, _, error in run_session(-1, args, args.settle, op_deltas) if error]
+
+    # 2. Everyone at once
+    snapshot_op_counts(reset=True)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        sessions = list(executor.map(lambda i: run_session(i, args), range(args.sessions)))
+    elapsed = time.perf_counter() - start
+    totals = snapshot_op_counts()
+
+    timings = defaultdict(list)
+    errors = list(profile_errors)
+    for results in sessions:
+        for action, seconds, error in results:
+            timings[action].append(seconds)
+            if error:
+                errors.append(error)
+    reruns = sum(len(results) for results in sessions)
+
+    report = {
+        "sessions": args.sessions,
+        "concurrency": args.concurrency,
+        "elapsed_seconds": round(elapsed, 3),
+        "reruns": reruns,
+        "reruns_per_second": round(reruns / elapsed, 2) if elapsed else 0.0,
+        "rerun_seconds": {
+            action: {
+                "count": len(values),
+                "p50": round(statistics.median(values), 4),
+                "p95": round(sorted(values)[min(len(values) - 1, int(len(values) * 0.95))], 4),
+            }
+            for action, values in timings.items()
+        },
+        "ops_per_action": summarize_profile(op_deltas),
+        "ops_total": totals,
+        "ops_per_rerun": {kind: round(count / reruns, 3) for kind, count in totals.items()} if reruns else {},
+        "errors": errors[:20],
+        "error_count": len(errors),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{reruns} reruns from {args.sessions} sessions ({args.concurrency} concurrent) in {elapsed:.1f}s "
+          f"-> {report['reruns_per_second']} reruns/s")
+    print(f"\n{'action':<18}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}   ops per action (profiled)")
+    for action, stats in report["rerun_seconds"].items():
+        ops = ", ".join(f"{kind}={count:g}" for kind, count in report["ops_per_action"].get(action, {}).items() if count)
+        print(f"{action:<18}{stats['count']:>7}{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}   {ops or '-'}")
+    print(f"\nbackend ops per rerun: {report['ops_per_rerun']}")
+    if errors:
+        print(f"\n{len(errors)} errors, first: {errors[0]}")
+
+
+if __name__ == "__main__":
+    main()
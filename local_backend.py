@@ -0,0 +1,532 @@
+"""In-process stand-ins for Firestore, Pyrebase auth, Stripe and the Anthropic API.
+
+Selected with TUTOR_BACKEND=local so the whole app runs offline, e.g. for development or the
+load tests in loadtest.py. Every backend call is tallied in OP_COUNTS.
+"""
+import copy
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+from anthropic.types import Message, TextBlock, ToolUseBlock, Usage
+from firebase_admin import firestore
+
+# Backend operations by kind, e.g. {"firestore_reads": 12, "firestore_writes": 4, "model_calls": 1}
+OP_COUNTS = Counter()
+_op_lock = threading.Lock()
+
+
+def count_op(kind, n=1):
+    with _op_lock:
+        OP_COUNTS[kind] += n
+
+
+def snapshot_op_counts(reset=False):
+    """Return a copy of OP_COUNTS, optionally zeroing it"""
+    with _op_lock:
+        counts = dict(OP_COUNTS)
+        if reset:
+            OP_COUNTS.clear()
+    return counts
+
+
+# ============================================================================
+# FIRESTORE
+# ============================================================================
+
+def _apply_fields(existing, data, merge):
+    """Apply a set() payload, resolving Increment / SERVER_TIMESTAMP / DELETE_FIELD like Firestore"""
+    result = copy.deepcopy(existing) if merge and existing else {}
+    for key, value in data.items():
+        if isinstance(value, firestore.Increment):
+            result[key] = (result.get(key) or 0) + value.value
+        elif value is firestore.SERVER_TIMESTAMP:
+            result[key] = datetime.now(timezone.utc)
+        elif value is firestore.DELETE_FIELD:
+            result.pop(key, None)
+        elif isinstance(value, dict):
+            # Nested maps may hold transforms too (e.g. {"tokens": {"qa": {"output": Increment(5)}}})
+            nested = result.get(key) if merge and isinstance(result.get(key), dict) else None
+            result[key] = _apply_fields(nested, value, merge)
+        else:
+            result[key] = copy.deepcopy(value)
+    return result
+
+
+class LocalFirestore:
+    """Dict-backed subset of the Firestore client API used by this app.
+
+    Documents are keyed by their full path ("users/a@b.com/usage/2024-01-01"). Pass a file
+    path to keep them in SQLite across restarts; otherwise they live in memory only.
+    """
+
+    def __init__(self, path=None):
+        self._docs = {}
+        self._lock = threading.RLock()
+        self._sqlite = None
+
+        if path:
+            self._sqlite = sqlite3.connect(path, check_same_thread=False)
+            self._sqlite.execute("CREATE TABLE IF NOT EXISTS docs (path TEXT PRIMARY KEY, data BLOB)")
+            for doc_path, blob in self._sqlite.execute("SELECT path, data FROM docs"):
+                self._docs[doc_path] = pickle.loads(blob)
+
+    def collection(self, name):
+        return LocalCollection(self, name)
+
+    def batch(self):
+        return LocalBatch(self)
+
+    def transaction(self):
+        return LocalTransaction(self)
+
+    def _read(self, path):
+        count_op("firestore_reads")
+        with self._lock:
+            data = self._docs.get(path)
+            return copy.deepcopy(data) if data is not None else None
+
+    def _apply(self, writes):
+        """Apply [(path, data_or_None, merge)] atomically; None deletes the document"""
+        count_op("firestore_writes", len(writes))
+        with self._lock:
+            for path, data, merge in writes:
+                if data is None:
+                    self._docs.pop(path, None)
+                else:
+                    self._docs[path] = _apply_fields(self._docs.get(path), data, merge)
+            if self._sqlite is not None:
+                for path, _, _ in writes:
+                    if path in self._docs:
+                        self._sqlite.execute(
+                            "INSERT OR REPLACE INTO docs VALUES (?, ?)", (path, pickle.dumps(self._docs[path]))
+                        )
+                    else:
+                        self._sqlite.execute("DELETE FROM docs WHERE path = ?", (path,))
+                self._sqlite.commit()
+
+    def _children(self, collection_path):
+        prefix = collection_path + "/"
+        with self._lock:
+            return [
+                (path, copy.deepcopy(data)) for path, data in self._docs.items()
+                if path.startswith(prefix) and "/" not in path[len(prefix):]
+            ]
+
+
+class LocalSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        value = self._data
+        for part in field.split("."):
+            value = value[part]
+        return value
+
+
+class LocalDocumentReference:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return LocalCollection(self._db, f"{self.path}/{name}")
+
+    def get(self, transaction=None):
+        return LocalSnapshot(self, self._db._read(self.path))
+
+    def set(self, data, merge=False):
+        self._db._apply([(self.path, data, merge)])
+
+    def update(self, data):
+        self._db._apply([(self.path, data, True)])
+
+    def delete(self):
+        self._db._apply([(self.path, None, False)])
+
+
+_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "in": lambda a, b: a in b,
+    "not-in": lambda a, b: a not in b,
+    "array_contains": lambda a, b: isinstance(a, list) and b in a,
+}
+
+_MISSING = object()
+
+
+def _field(data, field_path):
+    for part in field_path.split("."):
+        if not isinstance(data, dict) or part not in data:
+            return _MISSING
+        data = data[part]
+    return data
+
+
+class LocalQuery:
+    def __init__(self, db, collection_path, filters=(), orders=(), limit_count=None, cursor=None):
+        self._db = db
+        self._path = collection_path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit_count
+        self._cursor = cursor
+
+    def _copy(self, **changes):
+        state = {
+            "filters": self._filters, "orders": self._orders,
+            "limit_count": self._limit, "cursor": self._cursor,
+        }
+        state.update(changes)
+        return LocalQuery(self._db, self._path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction=firestore.Query.ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit_count=count)
+
+    def start_after(self, values):
+        return self._copy(cursor=values)
+
+    def stream(self):
+        matches = []
+        for path, data in self._db._children(self._path):
+            # Like Firestore, documents without a filtered or ordered field never match
+            values = [_field(data, field) for field, _, _ in self._filters]
+            if any(value is _MISSING for value in values):
+                continue
+            if not all(_OPERATORS[op](value, expected) for value, (_, op, expected) in zip(values, self._filters)):
+                continue
+            if any(_field(data, field) is _MISSING for field, _ in self._orders):
+                continue
+            matches.append((path, data))
+
+        for field, direction in reversed(self._orders):
+            matches.sort(key=lambda item: _field(item[1], field), reverse=direction == firestore.Query.DESCENDING)
+
+        if self._cursor is not None:
+            matches = [item for item in matches if self._is_after_cursor(item[1])]
+        if self._limit is not None:
+            matches = matches[:self._limit]
+
+        # Billed like Firestore: one read per document returned, and at least one per query
+        count_op("firestore_reads", max(1, len(matches)))
+        return iter([LocalSnapshot(LocalDocumentReference(self._db, path), data) for path, data in matches])
+
+    def get(self):
+        return list(self.stream())
+
+    def _is_after_cursor(self, data):
+        for field, direction in self._orders:
+            value, cursor = _field(data, field), self._cursor.get(field)
+            if value == cursor:
+                continue
+            return (value < cursor) if direction == firestore.Query.DESCENDING else (value > cursor)
+        return False
+
+
+class LocalCollection(LocalQuery):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id=None):
+        return LocalDocumentReference(self._db, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return datetime.now(timezone.utc), ref
+
+
+class LocalBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append((reference.path, data, merge))
+
+    def update(self, reference, data):
+        self._writes.append((reference.path, data, True))
+
+    def delete(self, reference):
+        self._writes.append((reference.path, None, False))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        if writes:
+            self._db._apply(writes)
+
+
+class LocalTransaction(LocalBatch):
+    """Serializable transaction: holds the database lock from begin to commit.
+
+    Implements the hooks `firestore.transactional` drives, so transactional functions run
+    unchanged against LocalFirestore.
+    """
+
+    _read_only = False
+    _max_attempts = 1
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._db._lock.acquire()
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self):
+        try:
+            self._clean_up()
+        finally:
+            self._db._lock.release()
+
+    def _commit(self):
+        try:
+            self.commit()
+            self._clean_up()
+        finally:
+            self._db._lock.release()
+        return []
+
+
+# ============================================================================
+# AUTH & PAYMENTS
+# ============================================================================
+
+class LocalAuth:
+    """Pyrebase `auth()` stand-in with accounts held in memory"""
+
+    def __init__(self):
+        self._passwords = {}
+        self._lock = threading.Lock()
+
+    def create_user_with_email_and_password(self, email, password):
+        count_op("auth_calls")
+        if "@" not in email:
+            raise ValueError("INVALID_EMAIL")
+        if len(password) < 6:
+            raise ValueError("WEAK_PASSWORD : Password should be at least 6 characters")
+        with self._lock:
+            if email in self._passwords:
+                raise ValueError("EMAIL_EXISTS")
+            self._passwords[email] = password
+        return {"email": email, "localId": uuid.uuid4().hex, "idToken": uuid.uuid4().hex}
+
+    def sign_in_with_email_and_password(self, email, password):
+        count_op("auth_calls")
+        with self._lock:
+            if self._passwords.get(email) != password:
+                raise ValueError("INVALID_LOGIN_CREDENTIALS")
+        return {"email": email, "localId": uuid.uuid4().hex, "idToken": uuid.uuid4().hex}
+
+
+class _LocalCheckoutSession:
+    @staticmethod
+    def create(**params):
+        count_op("stripe_calls")
+        session_id = f"cs_local_{uuid.uuid4().hex}"
+        return type("CheckoutSession", (), {
+            "id": session_id,
+            "url": f"https://checkout.local/pay/{session_id}",
+            "expires_at": params.get("expires_at"),
+        })()
+
+
+class LocalStripe:
+    """The slice of the `stripe` module the app uses; checkout sessions get a fake URL"""
+
+    api_key = None
+
+    class checkout:
+        Session = _LocalCheckoutSession
+
+
+# ============================================================================
+# MODEL
+# ============================================================================
+
+def _last_user_text(messages):
+    for message in reversed(messages):
+        if message["role"] != "user":
+            continue
+        content = message["content"]
+        if isinstance(content, str):
+            return content
+        return " ".join(block.get("text", "") for block in content if isinstance(block, dict))
+    return ""
+
+
+def _estimate_tokens(kwargs):
+    text = str(kwargs.get("system", "")) + "".join(str(message["content"]) for message in kwargs["messages"])
+    return max(1, len(text) // 4)
+
+
+class LocalModelService:
+    """Deterministic fake of ModelService with configurable latency.
+
+    Replies depend only on the request, so runs are reproducible. `ttft` is the delay
+    before the first token and `tokens_per_second` paces the rest of the answer.
+    """
+
+    def __init__(self, ttft=0.2, tokens_per_second=100.0, answer_words=120):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.answer_words = answer_words
+
+        self.stats = {"requests": 0, "in_flight": 0, "queued": 0, "busy_rejections": 0, "retries": 0, "failures": 0}
+        self.token_stats = {
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "cache_creation_input_tokens": 0,
+        }
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ttft=float(os.getenv("TUTOR_FAKE_MODEL_TTFT", "0.2")),
+            tokens_per_second=float(os.getenv("TUTOR_FAKE_MODEL_TPS", "100")),
+        )
+
+    def for_user(self, user):
+        return LocalModelClient(self)
+
+    def cache_hit_rate(self):
+        return 0.0
+
+    def _respond(self, kwargs):
+        count_op("model_calls")
+        tool_choice = kwargs.get("tool_choice") or {}
+        prompt = _last_user_text(kwargs["messages"])
+
+        if tool_choice.get("type") == "tool":
+            content = [ToolUseBlock(
+                type="tool_use", id=f"toolu_{uuid.uuid4().hex[:24]}",
+                name=tool_choice["name"], input=self._tool_input(tool_choice["name"], prompt)
+            )]
+            output_words = len(str(content[0].input).split())
+            stop_reason = "tool_use"
+        else:
+            words = [f"Here is a short explanation of: {prompt[:80]}."]
+            words += [f"point{i}" for i in range(self.answer_words)]
+            text = " ".join(words)
+            output_words = len(text.split())
+            if output_words * 1.3 > kwargs["max_tokens"]:
+                text = " ".join(text.split()[:int(kwargs["max_tokens"] / 1.3)])
+                stop_reason = "max_tokens"
+            else:
+                stop_reason = "end_turn"
+            content = [TextBlock(type="text", text=text)]
+
+        input_tokens = _estimate_tokens(kwargs)
+        output_tokens = int(output_words * 1.3)
+        with self._lock:
+            self.stats["requests"] += 1
+            self.token_stats["input_tokens"] += input_tokens
+            self.token_stats["output_tokens"] += output_tokens
+
+        return Message(
+            id=f"msg_local_{uuid.uuid4().hex[:24]}", type="message", role="assistant",
+            model=kwargs["model"], content=content, stop_reason=stop_reason, stop_sequence=None,
+            usage=Usage(input_tokens=input_tokens, output_tokens=output_tokens,
+                        cache_creation_input_tokens=0, cache_read_input_tokens=0),
+        )
+
+    @staticmethod
+    def _tool_input(tool_name, prompt):
+        match = re.search(r"Create (\d+)", prompt)
+        count = int(match.group(1)) if match else 5
+        topic = re.search(r"'([^']+)'", prompt)
+        topic = topic.group(1) if topic else "General"
+
+        if tool_name == "record_quiz_questions":
+            return {"questions": [{
+                "question": f"[{topic}] Practice question {i + 1}?",
+                "options": {letter: f"Option {letter}{i + 1}" for letter in "ABCD"},
+                "answer": "ABCD"[i % 4],
+                "explanation": f"Option {'ABCD'[i % 4]}{i + 1} is correct.",
+            } for i in range(count)]}
+        if tool_name == "record_flashcards":
+            return {"cards": [
+                {"question": f"[{topic}] Term {i + 1}?", "answer": f"Definition {i + 1}."}
+                for i in range(count)
+            ]}
+        return {}
+
+    def _sleep_for(self, message):
+        return self.ttft + message.usage.output_tokens / self.tokens_per_second
+
+
+class _LocalStream:
+    def __init__(self, service, kwargs):
+        self._service = service
+        self._message = service._respond(kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    @property
+    def text_stream(self):
+        time.sleep(self._service.ttft)
+        words = "".join(block.text for block in self._message.content if block.type == "text").split(" ")
+        delay = 1.3 / self._service.tokens_per_second
+        for i, word in enumerate(words):
+            time.sleep(delay)
+            yield word if i == 0 else " " + word
+
+    def get_final_message(self):
+        return self._message
+
+
+class _LocalMessages:
+    def __init__(self, service):
+        self._service = service
+
+    def create(self, **kwargs):
+        message = self._service._respond(kwargs)
+        time.sleep(self._service._sleep_for(message))
+        return message
+
+    def stream(self, **kwargs):
+        return _LocalStream(self._service, kwargs)
+
+
+class LocalModelClient:
+    def __init__(self, service):
+        self.messages = _LocalMessages(service)
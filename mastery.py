@@ -0,0 +1,233 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from firebase_admin import firestore
+
+from telemetry import traced
+
+# Activity kinds tracked, each with an "overall" aggregate and one per topic
+KINDS = ("quiz", "flashcard")
+# Written as Increments so answers saved from other tabs and server processes add up
+COUNTER_FIELDS = ("attempts", "correct", "incorrect", "timed_answers")
+# Recomputed from the other fields on load rather than stored
+DERIVED_FIELDS = ("accuracy", "rolling_accuracy")
+# Rolling accuracy covers this many most recent answers
+ROLLING_WINDOW = 20
+
+# Quiz difficulty levels, easiest first. A topic moves one level at a time, and only after
+# this many answers at its current level, judged on those answers alone.
+DIFFICULTY_LEVELS = ("easy", "medium", "hard")
+DEFAULT_DIFFICULTY = "medium"
+ANSWERS_PER_DIFFICULTY_STEP = 5
+STEP_UP_ACCURACY = 0.8
+STEP_DOWN_ACCURACY = 0.5
+
+
+def empty_aggregate():
+    return {
+        "attempts": 0,
+        "correct": 0,
+        "incorrect": 0,
+        "accuracy": 0.0,
+        "recent": [],
+        "rolling_accuracy": 0.0,
+        "streak": 0,
+        "best_streak": 0,
+        "avg_latency_seconds": 0.0,
+        "timed_answers": 0,
+    }
+
+
+def quiz_difficulty(topic_stats):
+    """Difficulty to generate the next question at, given a topic's quiz aggregate (or None)"""
+    return (topic_stats or {}).get("difficulty", DEFAULT_DIFFICULTY)
+
+
+def adapt_difficulty(aggregate):
+    """Step the aggregate's difficulty up or down after enough answers at the current level"""
+    level = aggregate.get("difficulty", DEFAULT_DIFFICULTY)
+    answered = aggregate.get("answers_at_difficulty", 0) + 1
+
+    if answered >= ANSWERS_PER_DIFFICULTY_STEP:
+        recent = aggregate["recent"][-answered:]
+        accuracy = sum(recent) / len(recent)
+        index = DIFFICULTY_LEVELS.index(level)
+        if accuracy >= STEP_UP_ACCURACY and index < len(DIFFICULTY_LEVELS) - 1:
+            level, answered = DIFFICULTY_LEVELS[index + 1], 0
+        elif accuracy < STEP_DOWN_ACCURACY and index > 0:
+            level, answered = DIFFICULTY_LEVELS[index - 1], 0
+
+    aggregate["difficulty"] = level
+    aggregate["answers_at_difficulty"] = answered
+    return level
+
+
+def derive_fields(aggregate):
+    """Recompute the ratio fields from the stored counters and recent answers"""
+    aggregate["accuracy"] = aggregate["correct"] / aggregate["attempts"] if aggregate["attempts"] else 0.0
+    recent = aggregate["recent"]
+    aggregate["rolling_accuracy"] = sum(recent) / len(recent) if recent else 0.0
+    return aggregate
+
+
+def empty_mastery():
+    return {kind: {"overall": empty_aggregate(), "topics": {}} for kind in KINDS}
+
+
+def apply_result(aggregate, correct, latency_seconds=None):
+    """Fold one answer into an aggregate in place (O(1), no event scan)"""
+    aggregate["attempts"] += 1
+    aggregate["correct" if correct else "incorrect"] += 1
+    aggregate["accuracy"] = aggregate["correct"] / aggregate["attempts"]
+
+    aggregate["recent"] = (aggregate["recent"] + [1 if correct else 0])[-ROLLING_WINDOW:]
+    aggregate["rolling_accuracy"] = sum(aggregate["recent"]) / len(aggregate["recent"])
+
+    aggregate["streak"] = aggregate["streak"] + 1 if correct else 0
+    aggregate["best_streak"] = max(aggregate["best_streak"], aggregate["streak"])
+
+    if latency_seconds is not None:
+        # Running mean over every timed answer
+        timed = aggregate["timed_answers"] + 1
+        aggregate["avg_latency_seconds"] += (latency_seconds - aggregate["avg_latency_seconds"]) / timed
+        aggregate["timed_answers"] = timed
+    return aggregate
+
+
+class MasteryStore:
+    """Quiz answers and flashcard reviews as an event log plus precomputed per-topic stats.
+
+    Events are appended to users/{email}/events. The aggregates for every topic live in the
+    single document users/{email}/stats/mastery, which is updated on each write, so the
+    stats panels read one document and never scan events. The caller holds the loaded
+    document (e.g. in session state) and passes it back to `record`.
+
+    Counters are saved as `Increment`s. The order-dependent fields (recent answers, streaks,
+    latency mean, difficulty) are saved as values, so each user's writes, resets included,
+    go through one single-threaded queue and land in the order they were made.
+    """
+
+    def __init__(self, db, max_workers=8):
+        self.db = db
+        # A user always maps to the same single-threaded executor. Users share these lanes, so
+        # there are enough of them that one user's backlog rarely holds up another's reset.
+        self._executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"mastery-store-{i}")
+            for i in range(max_workers)
+        ]
+        # Users whose aggregates were seeded from legacy scores and aren't stored yet
+        self._unsaved = set()
+        self.stats = {"writes": 0, "failures": 0}
+
+    def _submit(self, email, fn, *args):
+        executor = self._executors[hash(email) % len(self._executors)]
+        # The caller's context carries its telemetry tags (mode, topic) over to the worker
+        future = executor.submit(contextvars.copy_context().run, fn, email, *args)
+        future.add_done_callback(self._count_result)
+        return future
+
+    def _count_result(self, future):
+        self.stats["failures" if future.exception() is not None else "writes"] += 1
+
+    def _user_ref(self, email):
+        return self.db.collection("users").document(email)
+
+    def _mastery_ref(self, email):
+        return self._user_ref(email).collection("stats").document("mastery")
+
+    @traced("firestore", "mastery.load")
+    def load(self, email, legacy_scores=None):
+        """Read the aggregates, seeding overall totals from the old quiz_score/flashcard_score fields"""
+        snapshot = self._mastery_ref(email).get()
+        if snapshot.exists:
+            self._unsaved.discard(email)
+            mastery = empty_mastery()
+            for kind, data in (snapshot.to_dict() or {}).items():
+                if kind in mastery:
+                    mastery[kind]["overall"].update(data.get("overall", {}))
+                    derive_fields(mastery[kind]["overall"])
+                    for topic, stored in data.get("topics", {}).items():
+                        mastery[kind]["topics"][topic] = derive_fields(dict(empty_aggregate(), **stored))
+            return mastery
+
+        mastery = empty_mastery()
+        legacy_scores = legacy_scores or {}
+        quiz = legacy_scores.get("quiz_score") or {}
+        flashcard = legacy_scores.get("flashcard_score") or {}
+        for kind, correct, incorrect in (
+            ("quiz", quiz.get("correct", 0), quiz.get("total", 0) - quiz.get("correct", 0)),
+            ("flashcard", flashcard.get("got_it", 0), flashcard.get("missed", 0)),
+        ):
+            overall = mastery[kind]["overall"]
+            overall.update(correct=correct, incorrect=incorrect, attempts=correct + incorrect)
+            derive_fields(overall)
+            if overall["attempts"]:
+                # Increments would start from zero, so the first write stores these totals outright
+                self._unsaved.add(email)
+        return mastery
+
+    def record(self, email, mastery, kind, topic, correct, latency_seconds=None):
+        """Update `mastery` in place and queue the event plus the touched aggregates as one batch.
+
+        Returns the write's future; failures are also counted in `stats`.
+        """
+        overall = apply_result(mastery[kind]["overall"], correct, latency_seconds)
+        topic_stats = apply_result(
+            mastery[kind]["topics"].setdefault(topic, empty_aggregate()), correct, latency_seconds
+        )
+        if kind == "quiz":
+            # Persisted with the score so the level survives across sessions
+            adapt_difficulty(topic_stats)
+
+        event = {
+            "kind": kind,
+            "topic": topic,
+            "correct": correct,
+            "latency_seconds": latency_seconds,
+            "created_at": firestore.SERVER_TIMESTAMP,
+        }
+        increments = {"attempts": 1, "correct" if correct else "incorrect": 1}
+        if latency_seconds is not None:
+            increments["timed_answers"] = 1
+        # Only the aggregates this answer changed are written; other topics are left alone
+        return self._submit(email, self._write, event, kind, topic, dict(overall), dict(topic_stats), increments)
+
+    @traced("firestore", "mastery.write")
+    def _write(self, email, event, kind, topic, overall, topic_stats, increments):
+        seeded = email in self._unsaved
+
+        def stored(aggregate):
+            fields = {
+                field: value for field, value in aggregate.items()
+                if field not in DERIVED_FIELDS and (seeded or field not in COUNTER_FIELDS)
+            }
+            if not seeded:
+                fields.update({field: firestore.Increment(value) for field, value in increments.items()})
+            return fields
+
+        batch = self.db.batch()
+        batch.set(self._user_ref(email).collection("events").document(), event)
+        batch.set(self._mastery_ref(email), {
+            kind: {"overall": stored(overall), "topics": {topic: stored(topic_stats)}}
+        }, merge=True)
+        batch.commit()
+        self._unsaved.discard(email)
+
+    def reset(self, email, timeout=10.0):
+        """Zero the aggregates (the event log is kept); returns the fresh document.
+
+        Queued behind the user's pending writes, so none of them can land after it. Raises
+        TimeoutError if it hasn't been written after `timeout` seconds (it stays queued and
+        still lands in order), or the write's own error if it failed.
+        """
+        try:
+            self._submit(email, self._reset).result(timeout=timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f"Progress reset for {email} still queued after {timeout:.0f}s") from None
+        return empty_mastery()
+
+    @traced("firestore", "mastery.reset")
+    def _reset(self, email):
+        self._mastery_ref(email).set(empty_mastery())
+        self._unsaved.discard(email)
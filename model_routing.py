@@ -0,0 +1,71 @@
+import re
+from dataclasses import dataclass
+
+from study_items import SchemaError
+
+FAST_MODEL = "claude-3-haiku-20240307"
+STRONG_MODEL = "claude-3-5-haiku-20241022"
+
+
+@dataclass(frozen=True)
+class Route:
+    model: str
+    max_tokens: int
+    escalations: int = 0
+
+
+# mode -> request class -> tier -> route. Edit this table to retune cost/latency per mode.
+ROUTING_POLICY = {
+    "qa": {
+        "short": {"free": Route(FAST_MODEL, 400), "pro": Route(FAST_MODEL, 600)},
+        "explain": {"free": Route(FAST_MODEL, 750), "pro": Route(STRONG_MODEL, 1200)},
+    },
+    "quiz": {
+        "batch": {"free": Route(FAST_MODEL, 2400), "pro": Route(FAST_MODEL, 2400)},
+    },
+    "flashcard": {
+        "deck": {"free": Route(FAST_MODEL, 2000), "pro": Route(FAST_MODEL, 2400)},
+    },
+}
+
+# Upper bound on max_tokens for escalated requests
+ESCALATION_MAX_TOKENS = 4000
+
+_FACTUAL_OPENERS = re.compile(r"^(what|who|when|where|which|define|is|are|does|do|name)\b", re.IGNORECASE)
+_EXPLAIN_WORDS = re.compile(r"\b(why|how|explain|step|steps|prove|derive|compare|solve|walk me)\b", re.IGNORECASE)
+
+
+def classify_question(question):
+    """'short' for quick factual lookups, 'explain' for anything that needs working through"""
+    if len(question.split()) <= 20 and _FACTUAL_OPENERS.match(question.strip()) and not _EXPLAIN_WORDS.search(question):
+        return "short"
+    return "explain"
+
+
+def pick_route(mode, tier="free", request_class=None):
+    """Look up the model and max_tokens for a request"""
+    classes = ROUTING_POLICY[mode]
+    if request_class not in classes:
+        request_class = next(iter(classes))
+    routes = classes[request_class]
+    return routes.get(tier, routes["free"])
+
+
+def escalate(route):
+    """Next step up after a truncated or invalid response: more room first, then a stronger model"""
+    if route.escalations == 0:
+        return Route(route.model, min(route.max_tokens * 2, ESCALATION_MAX_TOKENS), 1)
+    if route.escalations == 1:
+        return Route(STRONG_MODEL, ESCALATION_MAX_TOKENS, 2)
+    return None
+
+
+def run_with_escalation(route, attempt):
+    """Call `attempt(route)`, escalating and retrying while it raises SchemaError"""
+    while True:
+        try:
+            return attempt(route)
+        except SchemaError:
+            route = escalate(route)
+            if route is None:
+                raise
@@ -0,0 +1,367 @@
+import asyncio
+import datetime
+import queue
+import random
+import threading
+import time
+
+import httpx
+from anthropic import APIConnectionError, APIStatusError, AsyncAnthropic
+
+BACKGROUND_LANE = "__background__"
+
+
+# Anthropic doesn't cache prefixes shorter than this (Haiku's minimum; every routed model is a
+# Haiku). A breakpoint on a shorter prefix is ignored, so single-turn prompts aren't marked.
+MIN_CACHEABLE_TOKENS = 2048
+
+
+def _content_text(content):
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+
+def cache_conversation_prefix(messages, system=""):
+    """Mark everything before the newest message as a cacheable prefix, once it's long enough to cache"""
+    if len(messages) < 2:
+        return messages
+    # ~4 characters per token, as in conversation_context.estimate_tokens
+    prefix_tokens = (len(system) + sum(len(_content_text(msg["content"])) for msg in messages[:-1])) // 4
+    if prefix_tokens < MIN_CACHEABLE_TOKENS:
+        return messages
+
+    messages = list(messages)
+    prefix_end = messages[-2]
+    content = prefix_end["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [dict(block) for block in content]
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+    messages[-2] = {**prefix_end, "content": content}
+    return messages
+
+
+class ModelServiceBusy(RuntimeError):
+    """Raised when a request waits longer than `queue_timeout` for a free slot"""
+
+
+# Transient statuses worth retrying: timeouts, conflicts, rate limits, overload and server errors
+RETRYABLE_STATUSES = {408, 409, 429}
+
+
+def is_retryable(error):
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in RETRYABLE_STATUSES or error.status_code >= 500
+    return False
+
+
+def _parse_reset(value):
+    """Seconds until an RFC 3339 `anthropic-ratelimit-*-reset` timestamp"""
+    try:
+        reset_at = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    return (reset_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+
+class RateLimiter:
+    """Token bucket for outgoing requests, kept in sync with the provider's rate-limit headers.
+
+    Only touched from the service's event loop thread, so it needs no locking.
+    """
+
+    def __init__(self, requests_per_minute=50):
+        self.capacity = float(requests_per_minute)
+        self.tokens = float(requests_per_minute)
+        self.refill_per_second = requests_per_minute / 60.0
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+
+        self.stats = {"waits": 0, "seconds_waited": 0.0, "pauses": 0}
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_per_second)
+            self._updated = now
+
+            if now < self.paused_until:
+                delay = self.paused_until - now
+            elif self.tokens >= 1:
+                self.tokens -= 1
+                return
+            else:
+                delay = (1 - self.tokens) / self.refill_per_second
+
+            self.stats["waits"] += 1
+            self.stats["seconds_waited"] += delay
+            await asyncio.sleep(delay)
+
+    def observe(self, headers):
+        """Adopt the provider's view of our request budget from response headers"""
+        limit = headers.get("anthropic-ratelimit-requests-limit")
+        if limit and limit.isdigit() and int(limit) > 0:
+            self.capacity = float(limit)
+            self.refill_per_second = int(limit) / 60.0
+
+        remaining = headers.get("anthropic-ratelimit-requests-remaining")
+        if remaining and remaining.isdigit():
+            self.tokens = min(self.tokens, float(remaining))
+            if int(remaining) == 0:
+                self.pause(_parse_reset(headers.get("anthropic-ratelimit-requests-reset")))
+
+    def pause(self, seconds):
+        if seconds and seconds > 0:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.stats["pauses"] += 1
+
+
+class ModelService:
+    """One process-wide AsyncAnthropic client that every model call is routed through.
+
+    Calls run on a dedicated event loop thread over a shared HTTP/2 connection pool. A
+    global semaphore caps how many requests are in flight, and each user also gets a small
+    lane of their own so one busy session can't take every slot.
+    """
+
+    def __init__(self, api_key, max_concurrency=16, per_user_concurrency=2,
+                 request_timeout=60.0, queue_timeout=30.0, max_connections=32,
+                 requests_per_minute=50, max_retries=4, backoff_base=0.5, backoff_cap=20.0):
+        self.per_user_concurrency = per_user_concurrency
+        self.request_timeout = request_timeout
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="model-service", daemon=True)
+        self._thread.start()
+
+        http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(request_timeout, connect=10.0),
+        )
+        # Retries are ours (rate-limit aware, jittered), not the SDK's
+        self._client = AsyncAnthropic(
+            api_key=api_key, http_client=http_client, timeout=request_timeout, max_retries=0
+        )
+        self.rate_limiter = RateLimiter(requests_per_minute)
+
+        self._global_slots = asyncio.Semaphore(max_concurrency)
+        self._lanes = {}
+
+        self.stats = {"requests": 0, "in_flight": 0, "queued": 0, "busy_rejections": 0, "retries": 0, "failures": 0}
+        self.token_stats = {
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "cache_creation_input_tokens": 0,
+        }
+
+    def for_user(self, user):
+        """Return a client with the sync Anthropic `messages` interface bound to this user's lane"""
+        return ModelClient(self, user or BACKGROUND_LANE)
+
+    def create(self, user, **kwargs):
+        future = asyncio.run_coroutine_threadsafe(self._create(user, kwargs), self._loop)
+        return future.result()
+
+    def stream(self, user, **kwargs):
+        return _StreamHandle(self, user, kwargs)
+
+    async def _create(self, user, kwargs):
+        async with self._slot(user):
+            for attempt in range(self.max_retries + 1):
+                await self.rate_limiter.acquire()
+                try:
+                    raw = await self._client.messages.with_raw_response.create(**kwargs)
+                except Exception as e:
+                    await self._backoff(e, attempt)
+                    continue
+                self.rate_limiter.observe(raw.headers)
+                return self._record_usage(raw.parse())
+
+    async def _stream(self, user, kwargs, chunks):
+        try:
+            async with self._slot(user):
+                for attempt in range(self.max_retries + 1):
+                    await self.rate_limiter.acquire()
+                    sent_text = False
+                    try:
+                        async with self._client.messages.stream(**kwargs) as stream:
+                            self.rate_limiter.observe(stream.response.headers)
+                            async for text in stream.text_stream:
+                                sent_text = True
+                                chunks.put(("text", text))
+                            final_message = await stream.get_final_message()
+                            chunks.put(("done", self._record_usage(final_message)))
+                            return
+                    except Exception as e:
+                        # Once text has reached the student, a retry would repeat it
+                        if sent_text:
+                            raise
+                        await self._backoff(e, attempt)
+        except BaseException as e:
+            chunks.put(("error", e))
+            raise
+
+    def _record_usage(self, message):
+        """Add a response's token usage, including prompt-cache reads and writes, to the totals"""
+        usage = getattr(message, "usage", None)
+        if usage is not None:
+            for field in self.token_stats:
+                self.token_stats[field] += getattr(usage, field, None) or 0
+        return message
+
+    def cache_hit_rate(self):
+        """Share of prompt tokens served from the prompt cache"""
+        cached = self.token_stats["cache_read_input_tokens"]
+        total = cached + self.token_stats["input_tokens"] + self.token_stats["cache_creation_input_tokens"]
+        return cached / total if total else 0.0
+
+    async def _backoff(self, error, attempt):
+        """Sleep before the next attempt, or re-raise if the error is final"""
+        if not is_retryable(error) or attempt >= self.max_retries:
+            self.stats["failures"] += 1
+            raise error
+
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            self.rate_limiter.observe(response.headers)
+            try:
+                retry_after = float(response.headers.get("retry-after", ""))
+            except ValueError:
+                retry_after = None
+
+        if retry_after is not None:
+            # Hold every request, not just this one, until the provider says we may continue
+            self.rate_limiter.pause(retry_after)
+            delay = retry_after
+        else:
+            # Full jitter keeps a classroom's worth of retries from arriving in lockstep
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+        self.stats["retries"] += 1
+        await asyncio.sleep(delay)
+
+    def _slot(self, user):
+        return _Slot(self, user)
+
+    def _lane(self, user):
+        lane = self._lanes.get(user)
+        if lane is None:
+            lane = self._lanes[user] = {"slots": asyncio.Semaphore(self.per_user_concurrency), "refs": 0}
+        return lane
+
+
+class _Slot:
+    """Async context manager holding one per-user slot and one global slot"""
+
+    def __init__(self, service, user):
+        self.service = service
+        self.user = user
+        self.lane = None
+
+    async def __aenter__(self):
+        service = self.service
+        self.lane = service._lane(self.user)
+        self.lane["refs"] += 1
+        service.stats["queued"] += 1
+        try:
+            # Per-user lane first, so a user's backlog waits in their own queue
+            await asyncio.wait_for(self.lane["slots"].acquire(), service.queue_timeout)
+            try:
+                await asyncio.wait_for(service._global_slots.acquire(), service.queue_timeout)
+            except BaseException:
+                self.lane["slots"].release()
+                raise
+        except asyncio.TimeoutError:
+            self._drop_lane()
+            service.stats["busy_rejections"] += 1
+            raise ModelServiceBusy("The tutor is busy right now, please try again in a moment.")
+        except BaseException:
+            self._drop_lane()
+            raise
+        finally:
+            service.stats["queued"] -= 1
+
+        service.stats["requests"] += 1
+        service.stats["in_flight"] += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.service.stats["in_flight"] -= 1
+        self.service._global_slots.release()
+        self.lane["slots"].release()
+        self._drop_lane()
+
+    def _drop_lane(self):
+        self.lane["refs"] -= 1
+        if self.lane["refs"] == 0:
+            self.service._lanes.pop(self.user, None)
+
+
+class _StreamHandle:
+    """Sync context manager mirroring `Anthropic().messages.stream()` on top of the async loop"""
+
+    def __init__(self, service, user, kwargs):
+        self.service = service
+        self.user = user
+        self.kwargs = kwargs
+        self._chunks = queue.Queue()
+        self._future = None
+        self._final_message = None
+
+    def __enter__(self):
+        self._future = asyncio.run_coroutine_threadsafe(
+            self.service._stream(self.user, self.kwargs, self._chunks), self.service._loop
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self._future.done():
+            self._future.cancel()
+
+    @property
+    def text_stream(self):
+        while True:
+            kind, payload = self._chunks.get(timeout=self.service.request_timeout + self.service.queue_timeout)
+            if kind == "text":
+                yield payload
+            elif kind == "done":
+                self._final_message = payload
+                return
+            else:
+                raise payload
+
+    def get_final_message(self):
+        if self._final_message is None:
+            for _ in self.text_stream:
+                pass
+        return self._final_message
+
+
+class _Messages:
+    def __init__(self, service, user):
+        self._service = service
+        self._user = user
+
+    def create(self, **kwargs):
+        return self._service.create(self._user, **kwargs)
+
+    def stream(self, **kwargs):
+        return self._service.stream(self._user, **kwargs)
+
+
+class ModelClient:
+    """Stand-in for the sync `Anthropic` client whose calls go through a ModelService lane"""
+
+    def __init__(self, service, user):
+        self.user = user
+        self.messages = _Messages(service, user)
@@ -0,0 +1,80 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QuestionPool:
+    """Process-wide pool of pre-generated quiz questions, one queue per key.
+
+    Keys are whatever partitions the questions, e.g. (topic, difficulty).
+    `generate_batch(key)` must return a list of questions; it is called with large batch
+    prompts on a background worker whenever a key's queue drops below `low_water`.
+    """
+
+    def __init__(self, generate_batch, low_water=3, max_workers=2, wait_timeout=60):
+        self.generate_batch = generate_batch
+        self.low_water = low_water
+        self.wait_timeout = wait_timeout
+
+        self._pools = {}
+        self._refills = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="quiz-pool")
+
+        self.stats = {"served_from_pool": 0, "waited_for_batch": 0, "batches": 0, "failed_batches": 0}
+
+    def prewarm(self, topics):
+        """Start filling the given topics without waiting for them"""
+        for topic in topics:
+            self.refill(topic)
+
+    def size(self, topic):
+        with self._lock:
+            return len(self._pools.get(topic, ()))
+
+    def take(self, topic):
+        """Pop a question for the topic, waiting for a batch only when the pool is empty"""
+        with self._lock:
+            pool = self._pools.setdefault(topic, deque())
+            question = pool.popleft() if pool else None
+            remaining = len(pool)
+
+        if question is not None:
+            self.stats["served_from_pool"] += 1
+            if remaining < self.low_water:
+                self.refill(topic)
+            return question
+
+        # Cold topic: block on the (possibly already running) refill
+        self.stats["waited_for_batch"] += 1
+        self.refill(topic).result(timeout=self.wait_timeout)
+
+        with self._lock:
+            pool = self._pools[topic]
+            question = pool.popleft() if pool else None
+            remaining = len(pool)
+
+        if question is not None and remaining < self.low_water:
+            self.refill(topic)
+        return question
+
+    def refill(self, topic):
+        """Schedule a background batch for the topic, reusing one already in flight"""
+        with self._lock:
+            future = self._refills.get(topic)
+            if future is None or future.done():
+                future = self._executor.submit(self._fill, topic)
+                self._refills[topic] = future
+            return future
+
+    def _fill(self, topic):
+        try:
+            questions = self.generate_batch(topic)
+        except Exception:
+            self.stats["failed_batches"] += 1
+            raise
+
+        self.stats["batches"] += 1
+        with self._lock:
+            self._pools.setdefault(topic, deque()).extend(questions)
+        return len(questions)
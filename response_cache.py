@@ -0,0 +1,162 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+EMBEDDING_DIM = 512
+
+# "... in computer science" adds nothing once the topic is known, so it's dropped before matching
+FIELD_NAMES = (
+    "computer science", "cs", "programming", "coding", "mathematics", "maths", "math",
+    "science", "physics", "chemistry", "biology", "history", "geography",
+)
+
+# Numbers, operators, Roman numerals and single-letter variables: "derivative of x^3" and
+# "derivative of x^2" differ in one of these, as do "World War I" and "World War II", and
+# near-duplicates must agree on all of them. Numerals are whole words only, including a bare "i".
+_ROMAN_NUMERAL = r"(?=[ivxlcdm])m{0,3}(?:cm|cd|d?c{0,3})(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3})"
+_SIGNIFICANT_TOKEN = re.compile(
+    rf"\d+(?:\.\d+)?|[+\-*/^=<>%()\[\]{{}}|&~√∞∑∫π]|(?<![a-z])(?:{_ROMAN_NUMERAL}|[b-hj-z])(?![a-z])"
+)
+
+
+def normalize_question(question, topic=None):
+    """Lowercase, drop field qualifiers and punctuation and collapse whitespace so trivial variants share a key"""
+    question = question.lower()
+    fields = FIELD_NAMES + ((topic.lower(),) if topic else ())
+    pattern = "|".join(re.escape(field) for field in sorted(fields, key=len, reverse=True))
+    question = re.sub(rf"\b(?:in|for|within) (?:the )?(?:{pattern})\b", " ", question)
+    question = re.sub(r"[^\w\s]", " ", question)
+    return " ".join(question.split())
+
+
+def question_signature(question):
+    """The question's numbers, operators, Roman numerals and variables, in order"""
+    question = question.lower().replace("'", "")
+    # Hyphenated words ("merge-sort") aren't subtraction
+    question = re.sub(r"(?<=[a-z])-(?=[a-z])", " ", question)
+    return tuple(_SIGNIFICANT_TOKEN.findall(question))
+
+
+def embed_question(normalized):
+    """Hash word unigrams and character trigrams into a fixed-size, L2-normalized vector"""
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    features = normalized.split()
+    padded = f" {normalized} "
+    features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        bucket = int.from_bytes(digest[:4], "little") % EMBEDDING_DIM
+        sign = 1.0 if digest[4] & 1 else -1.0
+        vector[bucket] += sign
+
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class ResponseCache:
+    """Process-wide cache of first-turn Q&A answers, keyed by topic and question similarity.
+
+    Exact (normalized) matches are a dict lookup; near-duplicates are found by cosine
+    similarity, but only among the topic's questions with the same numbers, operators and
+    variables (see `question_signature`). Entries expire after `ttl_seconds` and the least
+    recently used entry is evicted once `max_entries` is reached.
+    """
+
+    def __init__(self, similarity_threshold=0.9, ttl_seconds=24 * 3600, max_entries=2000):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        # (topic, signature) -> keys of the entries that can be near matches for each other
+        self._groups = {}
+        self._lock = threading.Lock()
+
+        self.stats = {"lookups": 0, "hits": 0, "near_hits": 0, "seconds_saved": 0.0, "hit_seconds": 0.0}
+
+    def get(self, topic, question):
+        """Return a cached answer for the question, or None"""
+        started = time.perf_counter()
+        key = self._key(topic, question)
+
+        with self._lock:
+            self.stats["lookups"] += 1
+            self._expire()
+
+            entry = self._entries.get(key)
+            if entry is None:
+                key = self._nearest(key[:2], embed_question(key[2]))
+                entry = self._entries.get(key) if key else None
+                if entry is not None:
+                    self.stats["near_hits"] += 1
+
+            if entry is None:
+                return None
+
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            self.stats["seconds_saved"] += entry["generation_seconds"]
+            self.stats["hit_seconds"] += time.perf_counter() - started
+            return entry["answer"]
+
+    def put(self, topic, question, answer, generation_seconds=0.0):
+        key = self._key(topic, question)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                "answer": answer,
+                "vector": embed_question(key[2]),
+                "created_at": time.time(),
+                "generation_seconds": generation_seconds,
+            }
+            self._groups.setdefault(key[:2], set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def summary(self):
+        lookups = self.stats["lookups"]
+        hits = self.stats["hits"]
+        return {
+            "entries": len(self._entries),
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "seconds_saved": self.stats["seconds_saved"],
+            "avg_hit_ms": 1000 * self.stats["hit_seconds"] / hits if hits else 0.0,
+        }
+
+    @staticmethod
+    def _key(topic, question):
+        return (topic.lower(), question_signature(question), normalize_question(question, topic))
+
+    def _nearest(self, group, vector):
+        keys = list(self._groups.get(group, ()))
+        if not keys:
+            return None
+
+        matrix = np.stack([self._entries[key]["vector"] for key in keys])
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        return keys[best] if scores[best] >= self.similarity_threshold else None
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_seconds
+        # Entries are only re-ordered on use, so check them all rather than just the oldest
+        for key in [key for key, entry in self._entries.items() if entry["created_at"] < cutoff]:
+            self._remove(key)
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        group = self._groups.get(key[:2])
+        if group is not None:
+            group.discard(key)
+            if not group:
+                del self._groups[key[:2]]
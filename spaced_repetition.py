@@ -0,0 +1,179 @@
+import contextvars
+import heapq
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+
+from telemetry import traced
+
+# SM-2 grades for the two self-assessment buttons
+GRADE_GOOD = 4
+GRADE_AGAIN = 2
+
+MIN_EASE = 1.3
+DEFAULT_EASE = 2.5
+# A missed card comes back later in the same study session rather than tomorrow
+LAPSE_DELAY = timedelta(minutes=10)
+
+
+@dataclass
+class ReviewCard:
+    card_id: str
+    topic: str
+    question: str
+    answer: str
+    ease: float = DEFAULT_EASE
+    interval_days: int = 0
+    repetitions: int = 0
+    lapses: int = 0
+    due: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+
+    def to_doc(self):
+        return {
+            "topic": self.topic,
+            "question": self.question,
+            "answer": self.answer,
+            "ease": self.ease,
+            "interval_days": self.interval_days,
+            "repetitions": self.repetitions,
+            "lapses": self.lapses,
+            "due": self.due,
+        }
+
+    @classmethod
+    def from_doc(cls, card_id, data):
+        return cls(
+            card_id, data["topic"], data["question"], data["answer"],
+            data.get("ease", DEFAULT_EASE), data.get("interval_days", 0),
+            data.get("repetitions", 0), data.get("lapses", 0), data["due"],
+        )
+
+
+def sm2_schedule(card, grade, now):
+    """Apply one SM-2 review (grade 0-5) to `card` in place"""
+    if grade < 3:
+        card.repetitions = 0
+        card.interval_days = 0
+        card.lapses += 1
+        card.due = now + LAPSE_DELAY
+    else:
+        card.repetitions += 1
+        if card.repetitions == 1:
+            card.interval_days = 1
+        elif card.repetitions == 2:
+            card.interval_days = 6
+        else:
+            card.interval_days = round(card.interval_days * card.ease)
+        card.due = now + timedelta(days=card.interval_days)
+
+    card.ease = max(MIN_EASE, card.ease + 0.1 - (5 - grade) * (0.08 + (5 - grade) * 0.02))
+    return card
+
+
+class _Deck:
+    """One user's scheduled cards for one topic, as a min-heap of (due, card_id)"""
+
+    def __init__(self, cards, horizon):
+        self.cards = {card.card_id: card for card in cards}
+        self.heap = [(card.due, card.card_id) for card in cards]
+        heapq.heapify(self.heap)
+        # Cards past the load limit are all due at or after this; reload once it passes
+        self.horizon = horizon
+
+    def push(self, card):
+        self.cards[card.card_id] = card
+        heapq.heappush(self.heap, (card.due, card.card_id))
+
+    def peek(self):
+        # Entries for cards rescheduled since they were pushed are stale; drop them lazily
+        while self.heap:
+            due, card_id = self.heap[0]
+            card = self.cards.get(card_id)
+            if card is not None and card.due == due:
+                return card
+            heapq.heappop(self.heap)
+        return None
+
+
+class ReviewScheduler:
+    """Spaced-repetition queue of reviewed flashcards under users/{email}/cards/{card_id}.
+
+    Each (user, topic) deck is read once with an indexed `topic == ... order by due` query
+    (see firestore.indexes.json) and then kept in memory as a heap, so finding the next due
+    card is a local lookup. Reviews update the heap immediately and are written in the
+    background.
+    """
+
+    def __init__(self, db, load_limit=200, max_decks=5000, max_workers=2):
+        self.db = db
+        self.load_limit = load_limit
+        self.max_decks = max_decks
+        self._decks = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="review-scheduler")
+
+    def _cards_ref(self, email):
+        return self.db.collection("users").document(email).collection("cards")
+
+    @traced("firestore", "cards.load")
+    def _load(self, email, topic):
+        query = (
+            self._cards_ref(email)
+            .where(filter=firestore.FieldFilter("topic", "==", topic))
+            .order_by("due")
+            .limit(self.load_limit)
+        )
+        cards = [ReviewCard.from_doc(doc.id, doc.to_dict()) for doc in query.stream()]
+        horizon = cards[-1].due if len(cards) == self.load_limit else None
+        return _Deck(cards, horizon)
+
+    def _deck(self, email, topic, now):
+        key = (email, topic)
+        deck = self._decks.get(key)
+        if deck is None or (deck.horizon is not None and now >= deck.horizon):
+            deck = self._load(email, topic)
+            self._decks[key] = deck
+        self._decks.move_to_end(key)
+        while len(self._decks) > self.max_decks:
+            self._decks.popitem(last=False)
+        return deck
+
+    def next_due(self, email, topic, now=None):
+        """The most overdue card for this topic, or None if nothing is due yet"""
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            card = self._deck(email, topic, now).peek()
+        return card if card is not None and card.due <= now else None
+
+    def due_count(self, email, topic, now=None):
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            deck = self._deck(email, topic, now)
+            return sum(1 for card in deck.cards.values() if card.due <= now)
+
+    def review(self, email, topic, card, grade, now=None):
+        """Schedule `card` (a ReviewCard, or a Flashcard seen for the first time) after a review"""
+        now = now or datetime.now(timezone.utc)
+        if not isinstance(card, ReviewCard):
+            card = ReviewCard(self._cards_ref(email).document().id, topic, card.question, card.answer)
+
+        with self._lock:
+            sm2_schedule(card, grade, now)
+            self._deck(email, topic, now).push(card)
+
+        self._executor.submit(contextvars.copy_context().run, self._save, email, card.card_id, card.to_doc())
+        return card
+
+    @traced("firestore", "cards.save")
+    def _save(self, email, card_id, doc):
+        self._cards_ref(email).document(card_id).set(doc)
+
+    def forget(self, email):
+        """Drop a user's decks from memory (e.g. on logout)"""
+        with self._lock:
+            for key in [key for key in self._decks if key[0] == email]:
+                del self._decks[key]
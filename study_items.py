@@ -0,0 +1,158 @@
+from dataclasses import dataclass
+
+OPTION_LETTERS = ("A", "B", "C", "D")
+
+
+class SchemaError(ValueError):
+    """Raised when the model's structured output doesn't match the expected schema"""
+
+
+class TruncatedOutput(SchemaError):
+    """Raised when invalid output hit max_tokens, so a repair at the same size would fail too"""
+
+
+@dataclass
+class QuizQuestion:
+    question: str
+    options: dict
+    answer: str
+    explanation: str = ""
+
+
+@dataclass
+class Flashcard:
+    question: str
+    answer: str
+
+
+# Tool definitions used to force the model to reply with JSON matching these schemas
+QUIZ_TOOL = {
+    "name": "record_quiz_questions",
+    "description": "Record a list of multiple choice quiz questions for a student.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "questions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "question": {"type": "string"},
+                        "options": {
+                            "type": "object",
+                            "properties": {letter: {"type": "string"} for letter in OPTION_LETTERS},
+                            "required": list(OPTION_LETTERS),
+                        },
+                        "answer": {"type": "string", "enum": list(OPTION_LETTERS)},
+                        "explanation": {"type": "string"},
+                    },
+                    "required": ["question", "options", "answer", "explanation"],
+                },
+            }
+        },
+        "required": ["questions"],
+    },
+}
+
+FLASHCARD_TOOL = {
+    "name": "record_flashcards",
+    "description": "Record a list of study flashcards for a student.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "cards": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "question": {"type": "string"},
+                        "answer": {"type": "string"},
+                    },
+                    "required": ["question", "answer"],
+                },
+            }
+        },
+        "required": ["cards"],
+    },
+}
+
+
+def _text(value):
+    return value.strip() if isinstance(value, str) else ""
+
+
+def parse_quiz_questions(tool_input):
+    """Turn the quiz tool's input into QuizQuestion objects, skipping malformed items"""
+    items = tool_input.get("questions") if isinstance(tool_input, dict) else None
+    if not isinstance(items, list):
+        raise SchemaError("'questions' must be a list")
+
+    questions = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        options = item.get("options") if isinstance(item.get("options"), dict) else {}
+        options = {letter: _text(options.get(letter)) for letter in OPTION_LETTERS}
+        answer = _text(item.get("answer")).upper()[:1]
+        question = _text(item.get("question"))
+
+        if question and all(options.values()) and answer in OPTION_LETTERS:
+            questions.append(QuizQuestion(question, options, answer, _text(item.get("explanation"))))
+
+    if not questions:
+        raise SchemaError(
+            "no valid questions: each needs a non-empty 'question', options 'A'-'D' and an 'answer' letter"
+        )
+    return questions
+
+
+def parse_flashcards(tool_input):
+    """Turn the flashcard tool's input into Flashcard objects, skipping malformed items"""
+    items = tool_input.get("cards") if isinstance(tool_input, dict) else None
+    if not isinstance(items, list):
+        raise SchemaError("'cards' must be a list")
+
+    cards = [
+        Flashcard(_text(item.get("question")), _text(item.get("answer")))
+        for item in items
+        if isinstance(item, dict) and _text(item.get("question")) and _text(item.get("answer"))
+    ]
+    if not cards:
+        raise SchemaError("no valid cards: each needs a non-empty 'question' and 'answer'")
+    return cards
+
+
+def request_structured(client, tool, parse, prompt, repair_attempts=1, **request_kwargs):
+    """Call the model with `tool` forced, parse its input once, and ask for a repair on schema errors"""
+    messages = [{"role": "user", "content": prompt}]
+
+    for attempt in range(repair_attempts + 1):
+        response = client.messages.create(
+            tools=[tool],
+            tool_choice={"type": "tool", "name": tool["name"]},
+            messages=messages,
+            **request_kwargs
+        )
+        tool_use = next((block for block in response.content if block.type == "tool_use"), None)
+
+        try:
+            if tool_use is None:
+                raise SchemaError(f"expected a call to the {tool['name']} tool")
+            return parse(tool_use.input)
+        except SchemaError as e:
+            if response.stop_reason == "max_tokens":
+                raise TruncatedOutput(f"output was cut off at max_tokens ({e})") from e
+            if attempt == repair_attempts:
+                raise
+
+            # Show the model its own output and the validation error, then let it fix it
+            messages.append({"role": "assistant", "content": response.content})
+            if tool_use is None:
+                messages.append({"role": "user", "content": f"Invalid response: {e}. Use the {tool['name']} tool."})
+            else:
+                messages.append({"role": "user", "content": [{
+                    "type": "tool_result",
+                    "tool_use_id": tool_use.id,
+                    "is_error": True,
+                    "content": f"Invalid input: {e}. Call {tool['name']} again with corrected input.",
+                }]})
@@ -0,0 +1,302 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Tags (e.g. mode, topic) applied to every span opened in the current context
+_tags = contextvars.ContextVar("telemetry_tags", default={})
+
+# Span attributes broken out as labels in the percentile and Prometheus views
+GROUP_BY = ("kind", "name", "mode", "topic")
+
+
+class Span:
+    __slots__ = ("kind", "name", "attributes", "start", "duration", "error")
+
+    def __init__(self, kind, name, attributes):
+        self.kind = kind
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update({key: value for key, value in attributes.items() if value is not None})
+
+
+class Telemetry:
+    """In-process ring buffer of timed spans around model, Firestore and Stripe calls.
+
+    Recording is a deque append under a lock, so it's cheap enough to leave on. The buffer
+    keeps the last `capacity` spans; percentiles and exports describe that window.
+    """
+
+    def __init__(self, capacity=5000):
+        self._spans = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, kind, name, **attributes):
+        """Time the block; exceptions are recorded by class name and re-raised"""
+        span = Span(kind, name, {**_tags.get(), **attributes})
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            with self._lock:
+                self._spans.append(span)
+
+    def traced(self, kind, name=None):
+        """Decorator form of `span`, named after the function by default"""
+        def decorator(func):
+            span_name = name or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(kind, span_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @property
+    def capacity(self):
+        return self._spans.maxlen
+
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def summary(self, group_by=GROUP_BY):
+        """{label tuple: {"count", "errors", "p50", "p95", "sum"}} over the buffered spans"""
+        durations = defaultdict(list)
+        errors = defaultdict(int)
+        for span in self.spans():
+            key = tuple(_label(span, field) for field in group_by)
+            durations[key].append(span.duration)
+            if span.error:
+                errors[key] += 1
+
+        summary = {}
+        for key, values in durations.items():
+            values.sort()
+            summary[key] = {
+                "count": len(values),
+                "errors": errors[key],
+                "p50": _percentile(values, 0.50),
+                "p95": _percentile(values, 0.95),
+                "sum": sum(values),
+            }
+        return summary
+
+    def token_totals(self):
+        """{model: {"input_tokens": n, "output_tokens": n, ...}} over the buffered model spans"""
+        totals = defaultdict(lambda: defaultdict(int))
+        for span in self.spans():
+            if span.kind != "model":
+                continue
+            for field in ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"):
+                totals[span.attributes.get("model", "unknown")][field] += span.attributes.get(field) or 0
+        return totals
+
+    def prometheus_text(self, gauges=()):
+        """Prometheus text exposition format of the buffered window.
+
+        `gauges` are extra (name, help, value) samples owned by other components, e.g. the
+        model service's prompt-cache hit rate since the process started.
+        """
+        lines = [
+            "# HELP tutor_call_duration_seconds Latency of model, Firestore and Stripe calls (recent window).",
+            "# TYPE tutor_call_duration_seconds summary",
+        ]
+        errors = []
+        for key, stats in sorted(self.summary().items()):
+            labels = ",".join(f'{field}="{_escape(value)}"' for field, value in zip(GROUP_BY, key))
+            for quantile in ("0.5", "0.95"):
+                value = stats["p50"] if quantile == "0.5" else stats["p95"]
+                lines.append(f'tutor_call_duration_seconds{{{labels},quantile="{quantile}"}} {value:.6f}')
+            lines.append(f"tutor_call_duration_seconds_sum{{{labels}}} {stats['sum']:.6f}")
+            lines.append(f"tutor_call_duration_seconds_count{{{labels}}} {stats['count']}")
+            errors.append(f"tutor_call_errors{{{labels}}} {stats['errors']}")
+
+        lines += [
+            "# HELP tutor_call_errors Failed calls (recent window).",
+            "# TYPE tutor_call_errors gauge",
+            *errors,
+            "# HELP tutor_model_tokens Tokens used by model calls (recent window).",
+            "# TYPE tutor_model_tokens gauge",
+        ]
+        for model, fields in sorted(self.token_totals().items()):
+            for field, count in sorted(fields.items()):
+                lines.append(f'tutor_model_tokens{{model="{_escape(model)}",type="{field}"}} {count}')
+        for name, help_text, value in gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def otlp_json(self, service_name="ai-tutor-agent"):
+        """The buffered spans as an OTLP/JSON ExportTraceServiceRequest (for an OTel collector)"""
+        otel_spans = []
+        for span in self.spans():
+            attributes = {"span.kind": span.kind, **span.attributes}
+            if span.error:
+                attributes["error.type"] = span.error
+            otel_spans.append({
+                "traceId": os.urandom(16).hex(),
+                "spanId": os.urandom(8).hex(),
+                "name": f"{span.kind}.{span.name}",
+                "kind": 3,  # SPAN_KIND_CLIENT
+                "startTimeUnixNano": str(int(span.start * 1e9)),
+                "endTimeUnixNano": str(int((span.start + span.duration) * 1e9)),
+                "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()],
+                "status": {"code": 2 if span.error else 1},
+            })
+        return json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{"scope": {"name": "tutor.telemetry"}, "spans": otel_spans}],
+        }]})
+
+
+@contextmanager
+def tags(**values):
+    """Attach tags (e.g. mode="qa", topic="Math") to every span opened inside the block"""
+    token = _tags.set({**_tags.get(), **{key: value for key, value in values.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def set_tags(**values):
+    """Replace the current context's tags, e.g. once per script run when the mode is known"""
+    _tags.set({key: value for key, value in values.items() if value is not None})
+
+
+def _label(span, field):
+    if field == "kind":
+        return span.kind
+    if field == "name":
+        return span.name
+    return str(span.attributes.get(field, ""))
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _record_response(span, response):
+    usage = getattr(response, "usage", None)
+    span.set(
+        stop_reason=getattr(response, "stop_reason", None),
+        input_tokens=getattr(usage, "input_tokens", None),
+        output_tokens=getattr(usage, "output_tokens", None),
+        cache_read_input_tokens=getattr(usage, "cache_read_input_tokens", None),
+        cache_creation_input_tokens=getattr(usage, "cache_creation_input_tokens", None),
+    )
+
+
+class _TracedStream:
+    """Wraps a messages.stream() context manager; the span covers the whole stream"""
+
+    def __init__(self, telemetry, stream, kwargs, on_response):
+        self._telemetry = telemetry
+        self._stream = stream
+        self._kwargs = kwargs
+        self._on_response = on_response
+        self._span_cm = None
+        self._span = None
+        self._started = None
+
+    def __enter__(self):
+        self._span_cm = self._telemetry.span(
+            "model", "messages.stream", model=self._kwargs.get("model"), max_tokens=self._kwargs.get("max_tokens")
+        )
+        self._span = self._span_cm.__enter__()
+        self._started = time.perf_counter()
+        try:
+            self._inner = self._stream.__enter__()
+        except BaseException as e:
+            self._span_cm.__exit__(type(e), e, e.__traceback__)
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            return self._stream.__exit__(*exc_info)
+        finally:
+            self._span_cm.__exit__(*exc_info)
+
+    @property
+    def text_stream(self):
+        for i, text in enumerate(self._inner.text_stream):
+            if i == 0:
+                self._span.set(ttft_seconds=round(time.perf_counter() - self._started, 4))
+            yield text
+
+    def get_final_message(self):
+        message = self._inner.get_final_message()
+        _record_response(self._span, message)
+        if self._on_response is not None:
+            self._on_response(self._span, message)
+        return message
+
+
+class _TracedMessages:
+    def __init__(self, telemetry, messages, on_response):
+        self._telemetry = telemetry
+        self._messages = messages
+        self._on_response = on_response
+
+    def create(self, **kwargs):
+        with self._telemetry.span(
+            "model", "messages.create", model=kwargs.get("model"), max_tokens=kwargs.get("max_tokens")
+        ) as span:
+            response = self._messages.create(**kwargs)
+            _record_response(span, response)
+            if self._on_response is not None:
+                self._on_response(span, response)
+            return response
+
+    def stream(self, **kwargs):
+        return _TracedStream(self._telemetry, self._messages.stream(**kwargs), kwargs, self._on_response)
+
+
+class TracedModelClient:
+    """Wraps a client with the Anthropic `messages` interface so every call is recorded.
+
+    `on_response(span, message)` is called with each finished response, e.g. for accounting.
+    """
+
+    def __init__(self, client, telemetry=None, on_response=None):
+        self._client = client
+        self.messages = _TracedMessages(telemetry or TELEMETRY, client.messages, on_response)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+# Process-wide recorder; the store modules decorate their Firestore calls with it
+TELEMETRY = Telemetry()
+traced = TELEMETRY.traced
+span = TELEMETRY.span
@@ -0,0 +1,56 @@
+import json
+from types import SimpleNamespace
+
+from conversation_context import ConversationContext
+from model_service import cache_conversation_prefix
+
+SYSTEM = "You are a tutor helping with the subject: History."
+
+
+class FakeClient:
+    """Answers every summary request with a new summary"""
+
+    def __init__(self):
+        self.messages = self
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        return SimpleNamespace(content=[SimpleNamespace(text=f"Summary {self.calls}: " + "s" * 400)])
+
+
+def run_turns(context, history, turns):
+    """Ask `turns` questions; yields (system, window, prefix_stable) for each request"""
+    for _ in range(turns):
+        turn = len(history) // 2
+        history.append({"role": "user", "content": f"Question {turn} " + "q" * 600})
+        system, window = context.build(history, system=SYSTEM)
+        yield system, window, context.prefix_stable
+        if context._pending is not None:
+            # Let the background summary land before the next turn
+            context._pending[0].result()
+        history.append({"role": "assistant", "content": f"Answer {turn} " + "a" * 600})
+
+
+def test_consecutive_turns_share_a_byte_identical_prefix():
+    context = ConversationContext(FakeClient(), recent_turns=6, token_budget=4000)
+    history = []
+    requests = list(run_turns(context, history, 16))
+
+    # Turn 15 comes after the summary took over older turns and is long enough to cache
+    (system, window, _), (next_system, next_window, stable) = requests[14], requests[15]
+    assert context.summary
+    assert cache_conversation_prefix(next_window, next_system) is not next_window
+
+    prefix = json.dumps([system, window[:-1]])
+    assert stable
+    assert json.dumps([next_system, next_window[:len(window) - 1]]) == prefix
+
+
+def test_prefix_changes_only_when_turns_are_folded():
+    context = ConversationContext(FakeClient(), recent_turns=6, token_budget=4000)
+    history = []
+    stable = [stable for _, _, stable in run_turns(context, history, 30)]
+
+    # One change per fold of `recent_turns` turns, not one per turn
+    assert stable.count(False) <= 1 + 30 // 6
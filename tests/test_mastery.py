@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from local_backend import LocalFirestore
+from mastery import MasteryStore
+
+EMAIL = "student@example.com"
+
+
+def test_writes_from_two_tabs_add_up():
+    store = MasteryStore(LocalFirestore())
+    first_tab = store.load(EMAIL)
+    second_tab = store.load(EMAIL)
+
+    store.record(EMAIL, first_tab, "quiz", "Math", True).result()
+    store.record(EMAIL, second_tab, "quiz", "Math", False).result()
+
+    overall = store.load(EMAIL)["quiz"]["overall"]
+    assert (overall["attempts"], overall["correct"], overall["incorrect"]) == (2, 1, 1)
+    assert overall["accuracy"] == 0.5
+
+
+def test_reset_is_not_undone_by_queued_writes():
+    store = MasteryStore(LocalFirestore())
+    mastery = store.load(EMAIL)
+    for _ in range(10):
+        store.record(EMAIL, mastery, "flashcard", "History", True)
+
+    store.reset(EMAIL)
+
+    assert store.load(EMAIL)["flashcard"]["overall"]["attempts"] == 0
+
+
+def test_legacy_scores_are_kept_by_the_first_write():
+    store = MasteryStore(LocalFirestore())
+    mastery = store.load(EMAIL, {"quiz_score": {"correct": 3, "total": 4}})
+
+    store.record(EMAIL, mastery, "quiz", "Math", True).result()
+
+    overall = store.load(EMAIL)["quiz"]["overall"]
+    assert (overall["attempts"], overall["correct"]) == (5, 4)
+
+
+class HeldBatchFirestore(LocalFirestore):
+    """Local store whose batch commits wait until `release` is set"""
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def batch(self):
+        batch = super().batch()
+        commit = batch.commit
+
+        def held_commit():
+            self.release.wait()
+            return commit()
+
+        batch.commit = held_commit
+        return batch
+
+
+def test_reset_lands_after_a_write_still_in_flight():
+    db = HeldBatchFirestore()
+    store = MasteryStore(db)
+    mastery = store.load(EMAIL)
+    pending = store.record(EMAIL, mastery, "quiz", "Math", True)
+
+    # The reset is queued behind the held write, so it times out but stays queued
+    with pytest.raises(TimeoutError):
+        store.reset(EMAIL, timeout=0.1)
+
+    db.release.set()
+    pending.result()
+    deadline = time.monotonic() + 5
+    while store.load(EMAIL)["quiz"]["overall"]["attempts"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert store.load(EMAIL)["quiz"]["overall"]["attempts"] == 0
+
+
+def test_failed_reset_raises_to_the_caller(monkeypatch):
+    store = MasteryStore(LocalFirestore())
+
+    def fail(email):
+        raise RuntimeError("firestore unavailable")
+
+    monkeypatch.setattr(store, "_reset", fail)
+    with pytest.raises(RuntimeError):
+        store.reset(EMAIL)
@@ -0,0 +1,61 @@
+import pytest
+
+from response_cache import ResponseCache, question_signature
+
+
+def make_cache():
+    return ResponseCache(similarity_threshold=0.9)
+
+
+def test_different_exponent_is_not_a_near_hit():
+    cache = make_cache()
+    cache.put("Math", "What is the derivative of x^3?", "3x^2")
+
+    assert cache.get("Math", "What is the derivative of x^2?") is None
+
+
+def test_different_operator_is_not_an_exact_hit():
+    cache = make_cache()
+    cache.put("Math", "What is 6 * 3?", "18")
+
+    assert cache.get("Math", "What is 6 / 3?") is None
+
+
+
+@pytest.mark.parametrize("topic, cached, asked", [
+    ("History", "What caused World War II?", "What caused World War I?"),
+    ("History", "Who was Henry VIII?", "Who was Henry VII?"),
+    ("Math", "What is a Type II error?", "What is a Type I error?"),
+])
+def test_different_roman_numeral_is_a_miss(topic, cached, asked):
+    cache = make_cache()
+    cache.put(topic, cached, "cached answer")
+
+    assert cache.get(topic, asked) is None
+
+def test_field_qualifier_paraphrase_is_a_hit():
+    cache = make_cache()
+    cache.put("Data Structures and Algorithms", "What is a linked list?", "A chain of nodes.")
+
+    assert cache.get(
+        "Data Structures and Algorithms", "What is a linked list in computer science?"
+    ) == "A chain of nodes."
+
+
+def test_topic_name_qualifier_is_ignored():
+    cache = make_cache()
+    cache.put("Biology", "What does mitochondria do?", "Makes ATP.")
+
+    assert cache.get("Biology", "what does mitochondria do in biology") == "Makes ATP."
+
+
+def test_near_duplicate_wording_is_a_hit():
+    cache = make_cache()
+    cache.put("Math", "What is the derivative of x^3?", "3x^2")
+
+    assert cache.get("Math", "what is the derivative of  x ^ 3") == "3x^2"
+
+
+def test_signature_ignores_hyphenated_words_and_articles():
+    assert question_signature("What is a merge-sort?") == ()
+    assert question_signature("Solve 2x + 3 = 7 for x") == ("2", "x", "+", "3", "=", "7", "x")
@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+import pytest
+
+from local_backend import LocalFirestore
+from token_meter import TokenMeter
+from write_behind import WriteBehindBuffer
+
+
+def usage_doc(db, email, day):
+    return db.collection("users").document(email).collection("usage").document(day).get().to_dict()
+
+
+def test_updates_to_one_document_coalesce_into_one_write():
+    db = LocalFirestore()
+    buffer = WriteBehindBuffer(db, flush_interval=3600)
+    ref = db.collection("users").document("a@example.com")
+
+    buffer.set(ref, {"name": "Ada", "prefs": {"theme": "dark"}})
+    buffer.set(ref, {"prefs": {"theme": "light"}})
+    buffer.increment(ref, {"stats": {"answers": 1}})
+    buffer.increment(ref, {"stats": {"answers": 2}})
+
+    assert buffer.flush() == 1
+    assert buffer.stats["writes"] == 1
+    assert ref.get().to_dict() == {"name": "Ada", "prefs": {"theme": "light"}, "stats": {"answers": 3}}
+
+
+def test_failed_flush_is_requeued_without_losing_deltas():
+    db = LocalFirestore()
+    buffer = WriteBehindBuffer(db, flush_interval=3600)
+    ref = db.collection("users").document("a@example.com")
+    buffer.increment(ref, {"answers": 1})
+
+    def fail():
+        raise RuntimeError("firestore unavailable")
+
+    def failing_batch():
+        batch = LocalFirestore.batch(db)
+        batch.commit = fail
+        return batch
+
+    db.batch = failing_batch
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+
+    buffer.increment(ref, {"answers": 1})
+    del db.batch
+    buffer.flush()
+    assert ref.get().to_dict() == {"answers": 2}
+
+
+def test_token_usage_is_buffered_until_flush():
+    db = LocalFirestore()
+    meter = TokenMeter(db, flush_interval=3600)
+    usage = SimpleNamespace(input_tokens=100, output_tokens=50)
+
+    meter.record("a@example.com", "2024-01-01", "qa", "claude-3-haiku-20240307", usage)
+    meter.record("a@example.com", "2024-01-01", "qa", "claude-3-haiku-20240307", usage)
+    assert usage_doc(db, "a@example.com", "2024-01-01") is None
+
+    meter.flush()
+    stored = usage_doc(db, "a@example.com", "2024-01-01")
+    assert stored["date"] == "2024-01-01"
+    assert stored["tokens"]["qa"]["input_tokens"] == 200
+    assert stored["tokens"]["qa"]["output_tokens"] == 100
@@ -0,0 +1,141 @@
+import threading
+from collections import defaultdict
+
+from model_routing import FAST_MODEL, STRONG_MODEL
+from telemetry import traced
+from write_behind import WriteBehindBuffer
+
+# Token counts taken from each response's `usage`
+TOKEN_FIELDS = ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
+
+# USD per million input/output tokens. Prompt-cache writes cost 1.25x input, reads 0.1x.
+MODEL_PRICES = {
+    FAST_MODEL: (0.25, 1.25),
+    STRONG_MODEL: (0.80, 4.00),
+}
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.1
+
+# Cache reads are billed at a tenth of the input price, so they count a tenth against budgets
+CACHE_READ_BUDGET_WEIGHT = 0.1
+
+# Account for shared background calls (e.g. quiz pool refills) that no one student made.
+# Its days are stored in system_usage/{YYYY-MM-DD} with the same fields as a user's.
+SYSTEM_ACCOUNT = "__system__"
+
+
+def billable_tokens(tokens):
+    """Tokens counted against a budget for one usage dict"""
+    return (
+        tokens.get("input_tokens", 0)
+        + tokens.get("output_tokens", 0)
+        + tokens.get("cache_creation_input_tokens", 0)
+        + tokens.get("cache_read_input_tokens", 0) * CACHE_READ_BUDGET_WEIGHT
+    )
+
+
+def estimate_cost(model, tokens):
+    """Estimated USD cost of one usage dict (unknown models are priced as the strong model)"""
+    input_price, output_price = MODEL_PRICES.get(model, MODEL_PRICES[STRONG_MODEL])
+    return (
+        tokens.get("input_tokens", 0) * input_price
+        + tokens.get("cache_creation_input_tokens", 0) * input_price * CACHE_WRITE_MULTIPLIER
+        + tokens.get("cache_read_input_tokens", 0) * input_price * CACHE_READ_MULTIPLIER
+        + tokens.get("output_tokens", 0) * output_price
+    ) / 1_000_000
+
+
+class TokenMeter:
+    """Per-user, per-day, per-mode token usage, kept in memory and flushed in the background.
+
+    Totals are stored next to the request counters in users/{email}/usage/{YYYY-MM-DD} as
+    `tokens.{mode}.{field}`. Deltas go through a WriteBehindBuffer, which adds them up per
+    day and writes them as `Increment`s, so several server processes can add to the same day.
+    A user's day is read once per process; after that `used` is a memory lookup (usage
+    recorded by other processes since then isn't seen until the next day).
+    Shared background calls are recorded under SYSTEM_ACCOUNT the same way.
+    """
+
+    def __init__(self, db, flush_interval=5.0):
+        self.db = db
+        self._buffer = WriteBehindBuffer(db, flush_interval=flush_interval, name="tokens")
+
+        self._totals = {}
+        self._loaded = set()
+        self._lock = threading.Lock()
+
+        self.stats = {"recorded": 0}
+
+    def _ref(self, email, day):
+        if email == SYSTEM_ACCOUNT:
+            return self.db.collection("system_usage").document(day)
+        return self.db.collection("users").document(email).collection("usage").document(day)
+
+    def _day(self, email, day):
+        # Called with the lock held
+        key = (email, day)
+        if key not in self._totals:
+            self._totals[key] = defaultdict(lambda: defaultdict(int))
+        return self._totals[key]
+
+    @traced("firestore", "tokens.load")
+    def load(self, email, day):
+        """Read a user's stored totals for the day, once per process"""
+        key = (email, day)
+        with self._lock:
+            if key in self._loaded:
+                return
+            self._loaded.add(key)
+            # Earlier days are finished; their unflushed deltas stay in the buffer until written
+            for old in [old for old in self._totals if old[1] < day]:
+                del self._totals[old]
+                self._loaded.discard(old)
+
+        try:
+            snapshot = self._ref(email, day).get()
+        except Exception:
+            with self._lock:
+                self._loaded.discard(key)
+            raise
+        stored = ((snapshot.to_dict() or {}) if snapshot.exists else {}).get("tokens", {})
+
+        with self._lock:
+            # Usage recorded while we were reading is already in memory; add the stored totals to it
+            totals = self._day(email, day)
+            for mode, fields in stored.items():
+                for field, value in fields.items():
+                    totals[mode][field] += value
+
+    def record(self, email, day, mode, model, usage):
+        """Add one response's `usage`; returns the user's billable tokens for the day"""
+        tokens = {field: getattr(usage, field, None) or 0 for field in TOKEN_FIELDS}
+        delta = dict(tokens, billable=billable_tokens(tokens), cost_usd=estimate_cost(model, tokens))
+
+        self._buffer.set(self._ref(email, day), {"date": day})
+        self._buffer.increment(self._ref(email, day), {"tokens": {mode: delta}})
+
+        with self._lock:
+            totals = self._day(email, day)
+            for field, value in delta.items():
+                totals[mode][field] += value
+            self.stats["recorded"] += 1
+            return sum(fields["billable"] for fields in totals.values())
+
+    def used(self, email, day):
+        """{"billable": n, "cost_usd": x, "modes": {mode: {field: n}}} for the user's day so far"""
+        with self._lock:
+            totals = self._totals.get((email, day), {})
+            modes = {mode: dict(fields) for mode, fields in totals.items()}
+        return {
+            "billable": sum(fields.get("billable", 0) for fields in modes.values()),
+            "cost_usd": sum(fields.get("cost_usd", 0) for fields in modes.values()),
+            "modes": modes,
+        }
+
+    def flush(self):
+        """Write out every pending delta now"""
+        return self._buffer.flush()
+
+    def close(self):
+        """Stop the background flush and write out what's left"""
+        self._buffer.close()
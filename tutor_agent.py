@@ -1,16 +1,19 @@
 import os
 from dotenv import load_dotenv
-from anthropic import Anthropic
+from conversation_context import ConversationContext
+from model_service import ModelService
 
 load_dotenv()
-client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+model_service = ModelService(api_key=os.getenv("ANTHROPIC_API_KEY"))
+client = model_service.for_user("cli")
 
 print("Welcome to your AI Tutor!")
 
-# Keep conversation history
-history = [
-    {"role": "user", "content": "You are an AI tutor. Answer questions clearly and helpfully. Be friendly, and explain things step-by-step if helpful."},
-]
+SYSTEM_PROMPT = "You are an AI tutor. Answer questions clearly and helpfully. Be friendly, and explain things step-by-step if helpful."
+
+# Keep conversation history (older turns get summarized so requests stay small)
+history = []
+context = ConversationContext(client, recent_turns=6, token_budget=4000)
 
 while True:
     user_input = input("Ask a question (or type 'exit'): ")
@@ -20,11 +23,13 @@ while True:
     # Append user's input to history
     history.append({"role": "user", "content": user_input})
 
+    system_prompt, messages = context.build(history, system=SYSTEM_PROMPT)
     response = client.messages.create(
         model="claude-3-haiku-20240307",
         max_tokens=1000,
         temperature=0.5,
-        messages=history,
+        system=system_prompt,
+        messages=messages,
     )
 
     answer = response.content[0].text.strip()
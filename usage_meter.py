@@ -0,0 +1,54 @@
+from firebase_admin import firestore
+
+from telemetry import traced
+
+# Usage mode -> counter field in the per-day usage document
+COUNTER_FIELDS = {"qa": "qa_count", "quiz": "quiz_count", "flashcard": "flashcard_count"}
+
+
+class UsageMeter:
+    """Daily usage counters kept in users/{email}/usage/{YYYY-MM-DD}.
+
+    Every change is a single-field `Increment`, and free-tier slots are claimed with a
+    transactional check-and-increment, so two tabs can't both take the last slot.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def _ref(self, email, day):
+        return self.db.collection("users").document(email).collection("usage").document(day)
+
+    @traced("firestore", "usage.load")
+    def load(self, email, day):
+        """Return today's counters, e.g. {"qa_count": 2, "quiz_count": 0, "flashcard_count": 1}"""
+        snapshot = self._ref(email, day).get()
+        data = snapshot.to_dict() if snapshot.exists else {}
+        return {field: data.get(field, 0) for field in COUNTER_FIELDS.values()}
+
+    @traced("firestore", "usage.try_reserve")
+    def try_reserve(self, email, mode, day, limit=None):
+        """Claim one slot for `mode`. Returns (allowed, count) where count includes the claim if allowed"""
+        field = COUNTER_FIELDS[mode]
+        ref = self._ref(email, day)
+
+        if limit is None:
+            # No cap to check (Pro), so skip the transaction
+            ref.set({field: firestore.Increment(1), "date": day}, merge=True)
+            return True, None
+
+        @firestore.transactional
+        def check_and_increment(transaction):
+            snapshot = ref.get(transaction=transaction)
+            count = (snapshot.to_dict() or {}).get(field, 0) if snapshot.exists else 0
+            if count >= limit:
+                return False, count
+            transaction.set(ref, {field: firestore.Increment(1), "date": day}, merge=True)
+            return True, count + 1
+
+        return check_and_increment(self.db.transaction())
+
+    @traced("firestore", "usage.release")
+    def release(self, email, mode, day):
+        """Hand back a slot claimed for a request that failed"""
+        self._ref(email, day).set({COUNTER_FIELDS[mode]: firestore.Increment(-1)}, merge=True)
@@ -0,0 +1,141 @@
+import atexit
+import copy
+import threading
+from collections import defaultdict
+
+from firebase_admin import firestore
+
+from telemetry import span
+
+
+def _nested():
+    return defaultdict(_nested)
+
+
+def _add(target, deltas):
+    """Add a nested dict of numeric deltas into `target`"""
+    for key, value in deltas.items():
+        if isinstance(value, dict):
+            _add(target[key], value)
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+def _increments(deltas):
+    return {
+        key: _increments(value) if isinstance(value, dict) else firestore.Increment(value)
+        for key, value in deltas.items()
+    }
+
+
+def _merge(fields, extra):
+    """Deep-merge `extra` into a copy of `fields`"""
+    merged = dict(fields)
+    for key, value in extra.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class WriteBehindBuffer:
+    """Coalesce per-document updates in memory and flush them to Firestore in the background.
+
+    `set` values replace earlier ones for the same field; `increment` deltas add up and are
+    written as `Increment`, so several processes can add to the same document. Each dirty
+    document gets a single `set(..., merge=True)`, and documents dirty at the same flush go
+    out together in batched commits.
+    """
+
+    # Firestore rejects batches with more than 500 writes
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self, db, flush_interval=2.0, name="write_behind"):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.name = name
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self.stats = {"updates": 0, "writes": 0, "batches": 0, "failures": 0}
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _entry(self, ref):
+        # Called with the lock held
+        entry = self._pending.get(ref.path)
+        if entry is None:
+            entry = self._pending[ref.path] = {"ref": ref, "fields": {}, "deltas": _nested()}
+        return entry
+
+    def set(self, ref, fields):
+        """Queue fields for the document; later values for the same field replace earlier ones"""
+        snapshot = copy.deepcopy(fields)
+        with self._lock:
+            entry = self._entry(ref)
+            entry["fields"] = _merge(entry["fields"], snapshot)
+            self.stats["updates"] += 1
+
+    def increment(self, ref, deltas):
+        """Queue a nested dict of numeric deltas for the document; deltas to the same field add up"""
+        with self._lock:
+            _add(self._entry(ref)["deltas"], deltas)
+            self.stats["updates"] += 1
+
+    def flush(self):
+        """Write out every buffered document now; returns how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._pending = self._pending, {}
+            if not dirty:
+                return 0
+
+            try:
+                self._write(dirty)
+            except Exception:
+                self.stats["failures"] += 1
+                self._requeue(dirty)
+                raise
+            return len(dirty)
+
+    def close(self):
+        """Stop the background thread and force a final flush"""
+        self._stop.set()
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+    def _write(self, dirty):
+        entries = list(dirty.values())
+        with span("firestore", f"{self.name}.flush", documents=len(entries)):
+            for start in range(0, len(entries), self.MAX_BATCH_SIZE):
+                chunk = entries[start:start + self.MAX_BATCH_SIZE]
+                batch = self.db.batch()
+                for entry in chunk:
+                    batch.set(entry["ref"], _merge(entry["fields"], _increments(entry["deltas"])), merge=True)
+                batch.commit()
+                self.stats["batches"] += 1
+                self.stats["writes"] += len(chunk)
+
+    def _requeue(self, dirty):
+        # Values set while we were writing are newer and win; deltas just add up again
+        with self._lock:
+            for failed in dirty.values():
+                entry = self._entry(failed["ref"])
+                entry["fields"] = _merge(failed["fields"], entry["fields"])
+                _add(entry["deltas"], failed["deltas"])
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                # Failed writes were re-queued; try again next tick
+                pass